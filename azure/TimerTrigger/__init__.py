@@ -1,51 +1,98 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import azure.functions as func
-from azure.storage.fileshare import ShareFileClient
 
-from tootify.tootifier import Tootifier
+from tootify.tootifier import Tootifier, sidecar_files
+
+from .share import AzureShare, LocalShare
 
 logger = logging.getLogger(__name__)
 
 
 @contextmanager
-def shared_file(conn_str, share_name, file_name):
+def shared_file(share, file_name):
+    """Yield a local copy of a config file and its sidecar files, and upload the files that have changed.
+
+    Sidecar files are uploaded before the config, so an uploaded config never lacks the state it relies on.
+    """
     with TemporaryDirectory() as tmp_dir:
         logger.debug(f"Created tmp dir {tmp_dir}")
-        file_client = ShareFileClient.from_connection_string(conn_str, share_name, file_name)
         remote_path = Path(file_name)
         local_path = Path(tmp_dir).joinpath(remote_path.name)
-        with open(local_path, "wb") as data:
-            logger.debug(f"Download {local_path}")
-            stream = file_client.download_file()
-            data.write(stream.readall())
+        logger.debug(f"Download {local_path}")
+        data, etag = share.download(file_name)
+        local_path.write_bytes(data)
+        files = []
+        for sidecar_path in sidecar_files(local_path):
+            try:
+                relative_path = sidecar_path.relative_to(tmp_dir)
+            except ValueError:
+                # Absolute paths are not part of the temporary copy
+                continue
+            if ".." in relative_path.parts:
+                raise ValueError(f"{relative_path} is outside of the directory of {file_name}")
+            remote_sidecar = str(remote_path.parent.joinpath(relative_path))
+            try:
+                sidecar_data, sidecar_etag = share.download(remote_sidecar)
+            except FileNotFoundError:
+                sidecar_data, sidecar_etag = None, None
+            else:
+                logger.debug(f"Download {sidecar_path}")
+                sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+                sidecar_path.write_bytes(sidecar_data)
+            files.append((remote_sidecar, sidecar_path, sidecar_data, sidecar_etag))
         yield local_path
-        with open(local_path, "rb") as source_file:
-            data = source_file.read()
-            logger.debug(f"Upload {local_path}")
-            file_client.upload_file(data)
+        for remote_file, path, old_data, old_etag in files + [(file_name, local_path, data, etag)]:
+            new_data = path.read_bytes() if path.exists() else None
+            if new_data is None or new_data == old_data:
+                logger.debug(f"Skip upload of unchanged {path}")
+            else:
+                logger.debug(f"Upload {path}")
+                share.upload(remote_file, new_data, old_etag)
+
+
+def run(share, path: str) -> bool:
+    try:
+        logger.info(f"Run tootifier {path}")
+        with shared_file(share, path) as config:
+            tootifyer = Tootifier(config)
+            try:
+                media_cache = tootifyer.config.get("media", {}).get("cache")
+                if media_cache and not Path(media_cache).is_absolute():
+                    raise ValueError("media.cache has to be absolute, the function runs on a copy of the config")
+                # Most runs find nothing new, so Mastodon is only connected if there is something to post
+                tootifyer.connect(probe=True)
+                tootifyer.toot()
+            finally:
+                # Write the state to the sidecar files before they are uploaded
+                tootifyer.close()
+        return True
+    except Exception as e:
+        logger.error(f"{path}: {e}")
+        return False
+
+
+def run_all(share, paths, max_workers: int = 4) -> int:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda path: run(share, path), paths))
+    return results.count(False)
 
 
 def main(timer: func.TimerRequest) -> None:
-    fails = 0
     logger.info(":".join(map(str, Path("/").iterdir())))
     config = os.environ.get("TOOTIFIER_CONFIG") or "config.yaml"
-    connection_string = os.environ.get("WEBSITE_CONTENTAZUREFILECONNECTIONSTRING")
-    share_name = os.environ.get("WEBSITE_CONTENTSHARE")
     logger.info(f"CONFIG: {config}")
-    for path in config.split(":"):
-        try:
-            logger.info(f"Run tootifier {path}")
-            with shared_file(connection_string, share_name, path) as config:
-                tootifyer = Tootifier(config)
-                tootifyer.connect()
-                tootifyer.toot()
-        except Exception as e:
-            logger.error(e)
-            fails += 1
+    if os.environ.get("TOOTIFIER_LOCAL_SHARE"):
+        share = LocalShare(Path(os.environ["TOOTIFIER_LOCAL_SHARE"]))
+    else:
+        share = AzureShare(
+            os.environ.get("WEBSITE_CONTENTAZUREFILECONNECTIONSTRING"), os.environ.get("WEBSITE_CONTENTSHARE")
+        )
+    fails = run_all(share, config.split(":"), max_workers=int(os.environ.get("TOOTIFIER_WORKERS") or 4))
     if fails:
         raise RuntimeError(f"{fails} executions failed")
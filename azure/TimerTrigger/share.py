@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentModification(RuntimeError):
+    pass
+
+
+class AzureShare:
+    """Config files on an Azure file share.
+
+    Azure Files does not support conditional writes, so uploads take a lease on the file and compare the ETag
+    while holding it. Files that did not exist when they were downloaded are uploaded with an ETag of ``None``.
+    """
+
+    def __init__(self, conn_str: str, share_name: str) -> None:
+        self._conn_str = conn_str
+        self._share_name = share_name
+
+    def _file_client(self, file_name: str):
+        from azure.storage.fileshare import ShareFileClient
+
+        return ShareFileClient.from_connection_string(self._conn_str, self._share_name, file_name)
+
+    def download(self, file_name: str) -> Tuple[bytes, str]:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            stream = self._file_client(file_name).download_file()
+        except ResourceNotFoundError as e:
+            raise FileNotFoundError(file_name) from e
+        return stream.readall(), stream.properties.etag
+
+    def upload(self, file_name: str, data: bytes, etag: Optional[str]) -> None:
+        file_client = self._file_client(file_name)
+        if etag is None:
+            file_client.upload_file(data)
+            return
+        lease = file_client.acquire_lease()
+        try:
+            if file_client.get_file_properties().etag != etag:
+                raise ConcurrentModification(f"{file_name} has been modified by another run")
+            file_client.upload_file(data, lease=lease)
+        finally:
+            lease.release()
+
+
+class LocalShare:
+    """Stand-in for ``AzureShare`` on the local file system, e.g. to run the function offline."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, root: Path) -> None:
+        self._root = root
+
+    def _etag(self, data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def download(self, file_name: str) -> Tuple[bytes, str]:
+        data = self._root.joinpath(file_name.lstrip("/")).read_bytes()
+        return data, self._etag(data)
+
+    def upload(self, file_name: str, data: bytes, etag: Optional[str]) -> None:
+        path = self._root.joinpath(file_name.lstrip("/"))
+        with self._lock:
+            current_etag = self._etag(path.read_bytes()) if path.exists() else None
+            if current_etag != etag:
+                raise ConcurrentModification(f"{file_name} has been modified by another run")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
@@ -0,0 +1,39 @@
+import argparse
+import json
+import logging
+from pathlib import Path
+
+from benchmarks.harness import SCENARIOS, format_result, format_startup, run_scenario, run_startup
+from tootify.cli import add_verbosity_argument, configure_logger
+
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(prog="Tootify benchmarks")
+parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})")
+parser.add_argument("--latency", type=float, default=0.005, help="Latency of every fake service in seconds")
+parser.add_argument("--payload-size", type=int, default=100_000, help="Size of every media file in bytes")
+parser.add_argument("--size", type=int, help="Override the number of posts/feeds of the scenarios")
+parser.add_argument("--trace-memory", action="store_true", help="Measure peak memory with tracemalloc (slow)")
+parser.add_argument("--startup", action="store_true", help="Measure cold imports and an idle probe run instead")
+parser.add_argument("--json", type=Path, help="Write the results to this file")
+add_verbosity_argument(parser)
+args = parser.parse_args()
+configure_logger(args)
+for scenario in args.scenarios:
+    if scenario not in SCENARIOS:
+        parser.error(f"unknown scenario {scenario}")
+
+results = []
+if args.startup:
+    result = run_startup(latency=args.latency, size=args.size or 20)
+    print(format_startup(result))
+    results.append(result)
+for scenario in args.scenarios or ([] if args.startup else SCENARIOS):
+    result = run_scenario(
+        scenario, latency=args.latency, payload_size=args.payload_size, size=args.size, trace_memory=args.trace_memory
+    )
+    print(format_result(result))
+    results.append(result)
+if args.json:
+    args.json.write_text(json.dumps(results, indent=2))
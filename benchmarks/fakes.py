@@ -0,0 +1,371 @@
+"""Local stand-ins for the services tootify talks to.
+
+Every fake runs its own ``ThreadingHTTPServer`` on localhost. ``route`` redirects requests made with ``requests`` from
+the real host names to these servers, so tootify can run unmodified against them.
+"""
+
+import email.utils
+import itertools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class FakeService:
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with service._lock:
+                    service.requests += 1
+                if service.latency:
+                    time.sleep(service.latency)
+                status, headers, content = service.handle(self.command, url.path, query, self.headers, body)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    try:
+                        self.wfile.write(content)
+                    except ConnectionError:
+                        # The client aborted the download
+                        self.close_connection = True
+
+            do_GET = do_POST = do_HEAD = do_PUT = _handle
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address
+        return f"{host}:{port}"
+
+    def start(self) -> "FakeService":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def json(self, data, status: int = 200, headers: Dict[str, str] = {}):
+        return status, {"Content-Type": "application/json", **headers}, json.dumps(data).encode()
+
+    def handle(self, method: str, path: str, query: Dict[str, str], headers, body: bytes):
+        return 404, {}, b""
+
+
+def _timestamp(offset: int = 0) -> str:
+    return (datetime(2023, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=offset)).isoformat()
+
+
+class FakeMastodon(FakeService):
+    """Videos are processed asynchronously like on a real instance: their upload returns 202 without a URL, and the
+    attachment only gets its URL ``processing_time`` seconds later.
+    """
+
+    def __init__(self, latency: float = 0, video_size_limit: int = 99 * 2**20, processing_time: float = 0.2) -> None:
+        super().__init__(latency)
+        self._video_size_limit = video_size_limit
+        self._processing_time = processing_time
+        self._processed: Dict[str, float] = {}
+        self._ids = itertools.count(1)
+        self.statuses: List[dict] = []
+        self.uploaded_bytes = 0
+
+    def _ratelimit_headers(self) -> Dict[str, str]:
+        reset = datetime.now(timezone.utc) + timedelta(minutes=5)
+        return {"X-RateLimit-Limit": "300", "X-RateLimit-Remaining": "300", "X-RateLimit-Reset": reset.isoformat()}
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith("/api/v1/instance") or path.startswith("/api/v2/instance"):
+            media_limits = {
+                "image_size_limit": 16 * 2**20,
+                "image_matrix_limit": 33_177_600,
+                "video_size_limit": self._video_size_limit,
+            }
+            return self.json(
+                {
+                    "uri": "mastodon.bench",
+                    "title": "bench",
+                    "version": "4.1.0",
+                    "configuration": {"media_attachments": media_limits},
+                }
+            )
+        if path == "/api/v1/accounts/verify_credentials":
+            return self.json({"id": "1", "username": "bench", "acct": "bench", "created_at": _timestamp()})
+        if method == "POST" and path in ("/api/v1/media", "/api/v2/media"):
+            with self._lock:
+                self.uploaded_bytes += len(body)
+            id = str(next(self._ids))
+            if b"Content-Type: video/" in body:
+                with self._lock:
+                    self._processed[id] = time.monotonic() + self._processing_time
+                return self.json({"id": id, "type": "video", "url": None}, 202)
+            return self.json({"id": id, "type": "image", "url": f"https://mastodon.bench/media/{id}"}, 200)
+        if method == "GET" and path.startswith("/api/v1/media/"):
+            id = path.rsplit("/", 1)[1]
+            with self._lock:
+                processed = self._processed.get(id)
+            if processed is None:
+                return self.json({"error": "not found"}, 404)
+            if time.monotonic() < processed:
+                return self.json({"id": id, "type": "video", "url": None}, 206)
+            return self.json({"id": id, "type": "video", "url": f"https://mastodon.bench/media/{id}"})
+        if method == "POST" and path == "/api/v1/statuses":
+            form = parse_qs(body.decode(errors="replace"))
+            media_ids = form.get("media_ids[]") or form.get("media_ids") or []
+            with self._lock:
+                unprocessed = [id for id in media_ids if time.monotonic() < self._processed.get(id, 0)]
+            if unprocessed:
+                return self.json({"error": "Cannot attach files that have not finished processing"}, 422)
+        if method == "POST" and path == "/api/v1/statuses":
+            id = str(next(self._ids))
+            status = {"id": id, "created_at": _timestamp(), "content": ""}
+            with self._lock:
+                self.statuses.append(status)
+            return self.json(status, headers=self._ratelimit_headers())
+        return self.json({"error": "not found"}, 404)
+
+
+class FakeMediaHost(FakeService):
+    """Serves ``payload_size`` bytes for every image below ``/media/``.
+
+    Videos named ``<key>_<bit rate>.mp4`` are as large as a ten second clip at that bit rate.
+    """
+
+    def __init__(self, latency: float = 0, payload_size: int = 100_000) -> None:
+        super().__init__(latency)
+        self._payload = b"\xff\xd8" + bytes(max(0, payload_size - 2))
+
+    def handle(self, method, path, query, headers, body):
+        match = re.fullmatch("/media/\\w+_(\\d+).mp4", path)
+        if match:
+            return 200, {"Content-Type": "video/mp4"}, bytes(int(match[1]) // 8 * 10)
+        if path.startswith("/media/"):
+            return 200, {"Content-Type": "image/jpeg"}, self._payload
+        return 404, {}, b""
+
+
+class FakeShortLinks(FakeService):
+    """Redirects ``/<code>`` to ``https://example.com/<code>`` and answers requests for the target."""
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith("/target/"):
+            return 200, {"Content-Type": "text/html"}, b"<html></html>"
+        return 301, {"Location": f"https://example.com/target{path}"}, b""
+
+
+class FakeTwitter(FakeService):
+    """Twitter API v2 user timeline with ``tweets`` tweets, each with ``media_per_tweet`` attachments and a short link.
+
+    Attachments are photos, or videos in three bit rates if ``media_type`` is ``"video"``. With ``thread_length``,
+    consecutive tweets form threads of that length.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        tweets: int = 500,
+        media_per_tweet: int = 0,
+        media_type: str = "photo",
+        thread_length: int = 1,
+    ) -> None:
+        super().__init__(latency)
+        self._tweets = tweets
+        self._media_per_tweet = media_per_tweet
+        self._media_type = media_type
+        self._thread_length = thread_length
+
+    def _media(self, key: str) -> dict:
+        if self._media_type == "video":
+            variants = [
+                {
+                    "bit_rate": bit_rate,
+                    "content_type": "video/mp4",
+                    "url": f"https://media.bench/media/{key}_{bit_rate}.mp4",
+                }
+                for bit_rate in (256000, 832000, 2176000)
+            ]
+            variants.append({"content_type": "application/x-mpegURL", "url": f"https://media.bench/media/{key}.m3u8"})
+            return {"media_key": key, "type": "video", "variants": variants}
+        return {"media_key": key, "type": "photo", "url": f"https://media.bench/media/{key}.jpg"}
+
+    def _tweet(self, id: int) -> dict:
+        # Threads start after the first tweet, which is already known to the benchmark configuration
+        conversation_id = id - (id - 2) % self._thread_length if id > 1 else id
+        tweet = {
+            "id": str(id),
+            "text": f"Tweet {id} #bench @someone https://t.co/link{id}",
+            "conversation_id": str(conversation_id),
+            "edit_history_tweet_ids": [str(id)],
+        }
+        if id != conversation_id:
+            tweet["referenced_tweets"] = [{"type": "replied_to", "id": str(id - 1)}]
+        if self._media_per_tweet:
+            tweet["attachments"] = {"media_keys": [f"3_{id}_{n}" for n in range(self._media_per_tweet)]}
+        return tweet
+
+    def _timeline(self, query):
+        max_results = int(query.get("max_results", 10))
+        since_id = int(query.get("since_id", 0))
+        start = int(query.get("pagination_token", self._tweets))
+        ids = [id for id in range(start, max(since_id, start - max_results), -1)]
+        data = [self._tweet(id) for id in ids]
+        media = [self._media(key) for tweet in data for key in tweet.get("attachments", {}).get("media_keys", [])]
+        meta = {"result_count": len(data)}
+        if data:
+            meta.update(newest_id=data[0]["id"], oldest_id=data[-1]["id"])
+        if ids and ids[-1] - 1 > since_id:
+            meta["next_token"] = str(ids[-1] - 1)
+        result = {"data": data, "meta": meta} if data else {"meta": meta}
+        if media:
+            result["includes"] = {"media": media}
+        return result
+
+    def handle(self, method, path, query, headers, body):
+        match = re.fullmatch("/2/users/by/username/(\\w+)", path)
+        if match:
+            return self.json({"data": {"id": "1", "name": "Bench", "username": match[1]}})
+        if re.fullmatch("/2/users/\\d+/tweets", path):
+            return self.json(self._timeline(query))
+        return self.json({"errors": [{"message": "not found"}]}, 404)
+
+
+class FakeInstagram(FakeService):
+    """Instagram Basic Display API with ``posts`` carousel posts of ``children`` images each."""
+
+    def __init__(self, latency: float = 0, posts: int = 100, children: int = 4, page_size: int = 25) -> None:
+        super().__init__(latency)
+        self._posts = posts
+        self._children = children
+        self._page_size = page_size
+
+    def _post(self, n: int) -> dict:
+        post = {
+            "id": str(n),
+            "caption": f"Post {n} #dogsofinstagram @someone",
+            "timestamp": _timestamp(n).replace("+00:00", "+0000"),
+        }
+        if self._children:
+            post["media_type"] = "CAROUSEL_ALBUM"
+            post["children"] = {
+                "data": [
+                    {"id": f"{n}_{child}", "media_url": f"https://media.bench/media/{n}_{child}.jpg"}
+                    for child in range(self._children)
+                ]
+            }
+        else:
+            post["media_type"] = "IMAGE"
+            post["media_url"] = f"https://media.bench/media/{n}.jpg"
+        return post
+
+    def handle(self, method, path, query, headers, body):
+        match = re.fullmatch("/(\\d+)/children", path)
+        if match:
+            return self.json(self._post(int(match[1]))["children"])
+        if path.endswith("/media"):
+            start = int(query.get("after", self._posts))
+            numbers = list(range(start, max(0, start - self._page_size), -1))
+            posts = [self._post(n) for n in numbers]
+            if "children" not in query.get("fields", ""):
+                for post in posts:
+                    post.pop("children", None)
+            result = {"data": posts}
+            if numbers and numbers[-1] > 1:
+                after = str(numbers[-1] - 1)
+                result["paging"] = {
+                    "cursors": {"after": after},
+                    "next": f"https://graph.instagram.com{path}?after={after}",
+                }
+            return self.json(result)
+        if "refresh_access_token" in path:
+            return self.json({"access_token": "bench", "token_type": "bearer", "expires_in": 5184000})
+        return self.json({"id": "1", "username": "bench", "account_type": "PERSONAL", "media_count": self._posts})
+
+
+class FakeFeeds(FakeService):
+    """RSS feeds at ``/feed/<n>.xml`` with ``entries`` items each. Conditional requests are answered with 304."""
+
+    def __init__(self, latency: float = 0, entries: int = 20) -> None:
+        super().__init__(latency)
+        self._entries = entries
+
+    def _feed(self, n: str) -> bytes:
+        items = "".join(
+            f"<item><title>Entry {n}-{i}</title><link>https://example.com/{n}/{i}</link>"
+            f"<description>Description {n}-{i}</description><guid>{n}-{i}</guid>"
+            f"<pubDate>{email.utils.format_datetime(datetime(2023, 1, 1, tzinfo=timezone.utc) - timedelta(hours=i))}"
+            "</pubDate></item>"
+            for i in range(self._entries)
+        )
+        return (
+            f'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed {n}</title>{items}</channel></rss>'.encode()
+        )
+
+    def handle(self, method, path, query, headers, body):
+        match = re.fullmatch("/feed/(\\w+).xml", path)
+        if not match:
+            return 404, {}, b""
+        etag = f'"{match[1]}"'
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"Content-Type": "application/rss+xml", "ETag": etag}, self._feed(match[1])
+
+
+class _LocalAdapter(HTTPAdapter):
+    def __init__(self, hosts: Dict[str, str]) -> None:
+        super().__init__()
+        self._hosts = hosts
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        url = urlsplit(original_url)
+        request.url = urlunsplit(("http", self._hosts[url.hostname], url.path, url.query, url.fragment))
+        response = super().send(request, **kwargs)
+        response.url = original_url
+        return response
+
+
+@contextmanager
+def route(hosts: Dict[str, FakeService]):
+    """Send all ``requests`` traffic for the given host names to the fake services."""
+    adapter = _LocalAdapter({host: service.address for host, service in hosts.items()})
+    get_adapter = requests.Session.get_adapter
+
+    def local_get_adapter(session, url):
+        if urlsplit(url).hostname in hosts:
+            return adapter
+        return get_adapter(session, url)
+
+    requests.Session.get_adapter = local_get_adapter
+    try:
+        yield
+    finally:
+        requests.Session.get_adapter = get_adapter
@@ -0,0 +1,283 @@
+import logging
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterator, List
+
+import yaml
+
+from benchmarks.fakes import (
+    FakeFeeds,
+    FakeInstagram,
+    FakeMastodon,
+    FakeMediaHost,
+    FakeShortLinks,
+    FakeTwitter,
+    route,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, stage: str, function: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - start)
+
+        return timed
+
+    def wrap_iter(self, stage: str, function: Callable) -> Callable:
+        # Sources may return generators, so every step of the iteration is measured
+        def timed(*args, **kwargs) -> Iterator:
+            iterator = iter(self.wrap(stage, function)(*args, **kwargs))
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.samples[stage].append(time.perf_counter() - start)
+                yield item
+
+        return timed
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, samples in self.samples.items():
+            quantiles = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+            result[stage] = {
+                "count": len(samples),
+                "total": sum(samples),
+                "p50": quantiles[49],
+                "p90": quantiles[89],
+                "p99": quantiles[98],
+            }
+        return result
+
+
+MASTODON_CONFIG = {
+    "access_token": "bench",
+    "client_id": "bench",
+    "client_secret": "bench",
+    "instance": "mastodon.bench",
+}
+# The fake instance has no rate limits, so the posting scheduler must not throttle either
+RATELIMIT_CONFIG = {"media_limit": 10**9, "status_limit": 10**9}
+
+
+def twitter_backlog(latency: float, payload_size: int, size: int):
+    media = FakeMediaHost(latency, payload_size)
+    links = FakeShortLinks(latency)
+    services = {
+        "api.twitter.com": FakeTwitter(latency, tweets=size, media_per_tweet=1),
+        "t.co": links,
+        "example.com": links,
+        "media.bench": media,
+    }
+    config = {"twitter": {"bearer_token": "bench", "username": "bench", "status": {"last_tweet": 1, "references": {}}}}
+    return services, config
+
+
+def twitter_video(latency: float, payload_size: int, size: int):
+    services, config = twitter_backlog(latency, payload_size, size)
+    services["api.twitter.com"] = FakeTwitter(latency, tweets=size, media_per_tweet=1, media_type="video")
+    return services, config
+
+
+def twitter_threads(latency: float, payload_size: int, size: int):
+    services, config = twitter_backlog(latency, payload_size, size)
+    services["api.twitter.com"] = FakeTwitter(latency, tweets=size, media_per_tweet=1, thread_length=5)
+    return services, {**config, "posting": {"workers": 4}}
+
+
+def feed_poll(latency: float, payload_size: int, size: int):
+    feeds = FakeFeeds(latency, entries=5)
+    config = {
+        "feed": {
+            "template": "{title} {link}",
+            "feeds": [
+                {"url": f"http://{feeds.address}/feed/{n}.xml", "last_update": "2022-12-31T00:00:00"}
+                for n in range(size)
+            ],
+            "status": {"references": {}},
+        }
+    }
+    return {"feeds.bench": feeds}, config
+
+
+def instagram_carousel(latency: float, payload_size: int, size: int):
+    services = {
+        "graph.instagram.com": FakeInstagram(latency, posts=size, children=4),
+        "api.instagram.com": FakeInstagram(latency, posts=size, children=4),
+        "media.bench": FakeMediaHost(latency, payload_size),
+    }
+    config = {
+        "instagram": {
+            "access_token": "bench",
+            "app_id": "bench",
+            "app_secret": "bench",
+            "expires_at": datetime.now() + timedelta(days=60),
+            "status": {"last_update": "2022-01-01T00:00:00+0000", "references": {}},
+        }
+    }
+    return services, config
+
+
+SCENARIOS = {
+    "twitter-backlog": (twitter_backlog, 500),
+    "twitter-video": (twitter_video, 100),
+    "twitter-threads": (twitter_threads, 200),
+    "feed-poll": (feed_poll, 200),
+    "instagram-carousel": (instagram_carousel, 50),
+}
+
+
+def run_scenario(
+    name: str, latency: float = 0.005, payload_size: int = 100_000, size: int = None, trace_memory: bool = False
+) -> Dict[str, Any]:
+    """Run a scenario against fresh fake services.
+
+    Peak memory is the peak RSS of the process, unless ``trace_memory`` is set. Then it is measured with tracemalloc,
+    which is more precise for a single scenario but slows the run down considerably.
+    """
+    from tootify.metrics import metrics
+    from tootify.tootifier import Tootifier
+
+    setup, default_size = SCENARIOS[name]
+    services, config = setup(latency, payload_size, size or default_size)
+    # The highest bit rate of the videos exceeds the size limit
+    mastodon = FakeMastodon(latency, video_size_limit=2 * 2**20)
+    services["mastodon.bench"] = mastodon
+    for service in set(services.values()):
+        service.start()
+    timer = StageTimer()
+    metrics.reset()
+    try:
+        with TemporaryDirectory() as tmp_dir, route(services):
+            status_path = Path(tmp_dir) / "config.yaml"
+            with status_path.open("w") as f:
+                yaml.dump(
+                    {"mastodon": MASTODON_CONFIG, "ratelimit": RATELIMIT_CONFIG, **config}, f, yaml.dumper.SafeDumper
+                )
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            tootifier = Tootifier(status_path)
+            timer.wrap("connect", tootifier.connect)()
+            tootifier._toot_media = timer.wrap("media", tootifier._toot_media)
+            tootifier._write_status = timer.wrap("write_status", tootifier._write_status)
+            tootifier._mastodon_api.status_post = timer.wrap("status_post", tootifier._mastodon_api.status_post)
+            for source in tootifier._sources.values():
+                source.get_new_posts = timer.wrap_iter("fetch", source.get_new_posts)
+            tootifier.toot()
+            elapsed = time.perf_counter() - start
+            if trace_memory:
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            else:
+                peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    finally:
+        for service in set(services.values()):
+            service.stop()
+    return {
+        "scenario": name,
+        "posts": len(mastodon.statuses),
+        "seconds": elapsed,
+        "posts_per_second": len(mastodon.statuses) / elapsed,
+        "uploaded_bytes": mastodon.uploaded_bytes,
+        "peak_memory": peak_memory,
+        "requests": {host: service.requests for host, service in services.items()},
+        "stages": timer.summary(),
+        "metrics": metrics.summary(),
+    }
+
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import tootify.tootifier, tootify.twitter, tootify.instagram, tootify.feed
+print(time.perf_counter() - start)
+print(" ".join(sorted(m for m in ("mastodon", "requests", "tweepy", "feedparser", "dateparser") if m in sys.modules)))
+"""
+
+
+def run_startup(latency: float = 0.005, size: int = 20, repeat: int = 5) -> Dict[str, Any]:
+    """Measure cold imports in fresh interpreters and an idle probe run that finds nothing new.
+
+    The probe run polls ``size`` feeds, which all answer with 304, so Mastodon must not be contacted at all.
+    """
+    import_times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+        seconds, imported = output.stdout.split("\n")[:2]
+        import_times.append(float(seconds))
+    from tootify.tootifier import Tootifier
+
+    services, config = feed_poll(latency, 0, size)
+    for feed in config["feed"]["feeds"]:
+        # The feeds have been seen before, so conditional requests return 304
+        feed["etag"] = f'"{feed["url"].rsplit("/", 1)[-1][:-4]}"'
+    mastodon = FakeMastodon(latency)
+    services["mastodon.bench"] = mastodon
+    for service in services.values():
+        service.start()
+    try:
+        with TemporaryDirectory() as tmp_dir, route(services):
+            status_path = Path(tmp_dir) / "config.yaml"
+            with status_path.open("w") as f:
+                yaml.dump({"mastodon": MASTODON_CONFIG, **config}, f, yaml.dumper.SafeDumper)
+            start = time.perf_counter()
+            tootifier = Tootifier(status_path)
+            tootifier.connect(probe=True)
+            tootifier.toot()
+            probe_seconds = time.perf_counter() - start
+    finally:
+        for service in services.values():
+            service.stop()
+    return {
+        "scenario": "startup",
+        "import_seconds": statistics.median(import_times),
+        "imported": imported.split(),
+        "probe_seconds": probe_seconds,
+        "mastodon_requests": mastodon.requests,
+        "requests": {host: service.requests for host, service in services.items()},
+    }
+
+
+def format_startup(result: Dict[str, Any]) -> str:
+    return "\n".join(
+        [
+            f"startup: cold import {result['import_seconds'] * 1000:.1f}ms "
+            f"(heavy modules loaded: {', '.join(result['imported']) or 'none'})",
+            f"  idle probe run {result['probe_seconds'] * 1000:.1f}ms, {result['mastodon_requests']} Mastodon requests",
+        ]
+    )
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    lines = [
+        f"{result['scenario']}: {result['posts']} posts in {result['seconds']:.2f}s "
+        f"({result['posts_per_second']:.1f} posts/s, peak memory {result['peak_memory'] / 2**20:.1f} MiB)",
+        f"  {'stage':<14}{'count':>8}{'total':>10}{'p50':>10}{'p90':>10}{'p99':>10}",
+    ]
+    for stage, summary in result["stages"].items():
+        lines.append(
+            f"  {stage:<14}{summary['count']:>8}{summary['total']:>9.3f}s"
+            + "".join(f"{summary[key] * 1000:>8.1f}ms" for key in ("p50", "p90", "p99"))
+        )
+    return "\n".join(lines)
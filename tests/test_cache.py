@@ -0,0 +1,32 @@
+import os
+from io import BytesIO
+
+from tootify.cache import MediaCache
+
+
+def put(cache, name, size):
+    return cache.put(f"https://example.com/{name}", BytesIO(name.encode() * size), "image/jpeg")
+
+
+def test_least_recently_used_blob_is_evicted(tmp_path):
+    cache = MediaCache(tmp_path, max_size=250)
+    first = put(cache, "a", 100)
+    os.utime(cache.get("https://example.com/a")[0], (0, 0))
+    put(cache, "b", 100)
+    put(cache, "c", 100)
+    assert cache.get("https://example.com/a") is None
+    assert cache.get("https://example.com/b") is not None
+    assert not (tmp_path / first[:2] / first).exists()
+
+
+def test_size_is_kept_in_the_index(tmp_path):
+    cache = MediaCache(tmp_path, max_size=250)
+    put(cache, "a", 100)
+    # The same content is stored and counted once
+    put(cache, "a", 100)
+    cache.save()
+    cache = MediaCache(tmp_path, max_size=250)
+    put(cache, "b", 100)
+    assert len(list(tmp_path.glob("*/*"))) == 2
+    put(cache, "c", 100)
+    assert len(list(tmp_path.glob("*/*"))) == 2
@@ -0,0 +1,40 @@
+from tootify.daemon import Daemon
+
+INTERVALS = {"min_interval": 0.01, "max_interval": 0.01, "max_backoff": 0.01}
+
+
+class FakeTootifier:
+    sources = ["instagram"]
+
+    def __init__(self, polls, errors=()):
+        self.daemon = None
+        self.connects = []
+        self.polls = []
+        self._remaining = polls
+        self._errors = errors
+
+    def connect_source(self, name):
+        self.connects.append(len(self.polls))
+
+    def toot_source(self, name, dry_run=False, skip=False):
+        self.polls.append(name)
+        self._remaining -= 1
+        if not self._remaining:
+            self.daemon.stop()
+        if len(self.polls) in self._errors:
+            raise RuntimeError("Access token has expired")
+        return 0
+
+
+def run(tootifier, **config):
+    tootifier.daemon = Daemon(tootifier, {**INTERVALS, **config})
+    tootifier.daemon.run()
+    return tootifier.connects
+
+
+def test_source_is_connected_again_after_failure():
+    assert run(FakeTootifier(polls=3, errors=[1])) == [1]
+
+
+def test_source_is_connected_again_periodically():
+    assert run(FakeTootifier(polls=3), reconnect_interval=0) == [0, 1, 2]
@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tootify.dedup import DuplicateIndex, YAMLFingerprints
+
+TEXT = "The same post arrives through two sources"
+
+
+def test_duplicate_waits_for_reservation():
+    fingerprints = []
+    index = DuplicateIndex(YAMLFingerprints(fingerprints))
+    text_hash = index.text_hash(TEXT)
+    duplicate, reservation = index.reserve(text_hash, [], "twitter")
+    assert duplicate is None
+    assert index.find(text_hash, [], "feed") is None
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(index.reserve, text_hash, [], "feed")
+        assert not future.done()
+        index.confirm(reservation, "1")
+        duplicate, reservation = future.result(timeout=5)
+    assert duplicate["id"] == "1"
+    assert reservation is None
+    assert [entry["id"] for entry in fingerprints] == ["1"]
+
+
+def test_released_reservation_is_taken_over():
+    fingerprints = []
+    index = DuplicateIndex(YAMLFingerprints(fingerprints))
+    text_hash = index.text_hash(TEXT)
+    _, reservation = index.reserve(text_hash, [], "twitter")
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(index.reserve, text_hash, [], "feed")
+        index.release(reservation)
+        duplicate, reservation = future.result(timeout=5)
+    assert duplicate is None
+    assert reservation["source"] == "feed"
+    assert fingerprints == []
+
+
+def test_concurrent_duplicates_are_reserved_once():
+    index = DuplicateIndex(YAMLFingerprints([]))
+    text_hash = index.text_hash(TEXT)
+    barrier = threading.Barrier(8)
+
+    def post(n):
+        barrier.wait()
+        duplicate, reservation = index.reserve(text_hash, [], f"source{n}")
+        if reservation:
+            index.confirm(reservation, str(n))
+        return duplicate
+
+    with ThreadPoolExecutor(8) as executor:
+        duplicates = list(executor.map(post, range(8)))
+    assert duplicates.count(None) == 1
+
+
+def test_posts_of_the_same_source_are_no_duplicates():
+    index = DuplicateIndex(YAMLFingerprints([]))
+    text_hash = index.text_hash(TEXT)
+    _, reservation = index.reserve(text_hash, [], "feed")
+    index.confirm(reservation, "1")
+    assert index.find(text_hash, [], "feed") is None
+    duplicate, reservation = index.reserve(text_hash, [], "feed")
+    assert duplicate is None
+    assert index.find(text_hash, [], "twitter")["id"] == "1"
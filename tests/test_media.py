@@ -0,0 +1,81 @@
+import pytest
+
+from benchmarks.fakes import FakeMediaHost
+from tootify.cache import MediaCache
+from tootify.media import MediaPipeline, MediaTooLarge, optimize_image
+from tootify.source import Media
+
+
+class FakeMastodon:
+    def __init__(self):
+        self.uploads = 0
+        self.sizes = []
+
+    def media_post(self, file, mime_type=None, description=None):
+        self.uploads += 1
+        self.sizes.append(len(file.read()))
+        return {"id": str(self.uploads), "url": f"https://example.com/media/{self.uploads}"}
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    pipeline = MediaPipeline(
+        FakeMastodon(), cache=MediaCache(tmp_path / "cache"), namespace="1@example.com", reuse_uploads=3600
+    )
+    yield pipeline
+    pipeline.close()
+
+
+@pytest.fixture
+def media():
+    host = FakeMediaHost(payload_size=1000).start()
+    yield [Media(f"http://{host.address}/media/1.jpg")]
+    host.stop()
+
+
+def test_attached_upload_is_not_reused(pipeline, media):
+    assert [result.id for result in pipeline.process(media)] == ["1"]
+    assert [result.id for result in pipeline.process(media)] == ["2"]
+
+
+def test_released_upload_is_reused_once(pipeline, media):
+    pipeline.release(pipeline.process(media))
+    assert [result.id for result in pipeline.process(media)] == ["1"]
+    assert [result.id for result in pipeline.process(media)] == ["2"]
+
+
+def test_cached_media_exceeding_the_limits_is_rejected(tmp_path, pipeline, media):
+    assert [result.ok for result in pipeline.process(media)] == [True]
+    limited = MediaPipeline(FakeMastodon(), cache=MediaCache(tmp_path / "cache"), max_download_size=500)
+    try:
+        [result] = limited.process(media)
+    finally:
+        limited.close()
+    assert isinstance(result.error, MediaTooLarge)
+
+
+def noise(path, size):
+    from PIL import Image
+
+    # Noise compresses badly, so the image exceeds the limit even at the lowest quality
+    Image.effect_noise((size, size), 100).convert("RGB").save(path, "PNG")
+    return path
+
+
+def test_image_is_downscaled_until_it_fits(tmp_path):
+    pytest.importorskip("PIL")
+    content, mime_type = optimize_image(noise(tmp_path / "noise.png", 400).read_bytes(), 20_000, 33_177_600)
+    assert mime_type == "image/jpeg"
+    assert len(content) <= 20_000
+
+
+def test_oversized_image_is_optimized_before_upload(tmp_path):
+    pytest.importorskip("PIL")
+    mastodon = FakeMastodon()
+    pipeline = MediaPipeline(mastodon, limits={"image_size_limit": 20_000})
+    try:
+        [result] = pipeline.process([Media(noise(tmp_path / "noise.png", 400).as_uri())])
+    finally:
+        pipeline.close()
+    assert result.ok
+    assert mastodon.sizes[0] <= 20_000
@@ -0,0 +1,63 @@
+from tootify.source import Rewriter, Source, Toot
+
+
+def rewrite(text, **config):
+    config = {
+        "handle_domain": "twitter.com",
+        "familiar_accounts": {"foo": "foo@mastodon.social"},
+        "common_hashtags": {"#foo": "#Foo", "#foobar": "#FooBar"},
+        **config,
+    }
+    return Rewriter(**config).rewrite(text)
+
+
+def test_handles_are_expanded():
+    assert rewrite("Thanks to @bar and @foo!") == "Thanks to @bar@twitter.com and @foo@mastodon.social!"
+
+
+def test_handle_at_the_start_is_expanded():
+    assert rewrite("@bar replied") == "@bar@twitter.com replied"
+
+
+def test_handle_is_not_expanded_within_another_handle():
+    assert rewrite("@foo and @foobar") == "@foo@mastodon.social and @foobar@twitter.com"
+
+
+def test_email_addresses_and_long_handles_are_kept():
+    assert rewrite("Write to mail@example.com or @sixteen_letters_") == "Write to mail@example.com or @sixteen_letters_"
+    assert rewrite("@sixteen_letters_", handle_length=16) == "@sixteen_letters_@twitter.com"
+
+
+def test_hashtags_are_translated_as_whole_words():
+    assert rewrite("#foo #foobar #foos #foo.") == "#Foo #FooBar #foos #Foo."
+
+
+def test_text_is_kept_without_rules():
+    assert rewrite("@foo #foo", handle_domain=None, common_hashtags={}) == "@foo #foo"
+
+
+class HistorySource(Source):
+    name = "history"
+
+    def connect(self):
+        pass
+
+    def get_new_posts(self):
+        return []
+
+
+def test_backfill_resumes_after_the_last_handled_toot():
+    source = HistorySource({})
+    posts = [(3, "3"), (1, "1"), (4, "4"), (2, "2")]
+    tootify = lambda reference: Toot(source, reference, f"Post {reference}")
+    history = source._backfill(posts, tootify)
+    toot = next(history)
+    assert toot.reference == "1"
+    assert "backfill" not in source.config["status"]
+    source.references["1"] = "100"
+    toot.checkpoint()
+    # The backfill is interrupted while the second toot is posted
+    assert next(history).reference == "2"
+    assert source.config["status"]["backfill"] == {"position": 1}
+    assert [toot.reference for toot in source._backfill(posts, tootify)] == ["2", "3", "4"]
+    assert "backfill" not in source.config["status"]
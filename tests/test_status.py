@@ -0,0 +1,31 @@
+import yaml
+
+from tootify.status import SQLiteStore
+from tootify.tootifier import Tootifier
+
+
+def test_references_are_migrated(tmp_path):
+    store = SQLiteStore(tmp_path / "tootify.db")
+    status = {"references": {1: "100", "2": "200"}, "last_tweet": 2}
+    store.migrate("twitter", status)
+    assert status == {"last_tweet": 2}
+    references = store.references("twitter")
+    assert dict(references) == {"1": "100", "2": "200"}
+    assert references[1] == "100"
+    assert 1 not in store.references("feed")
+    store.close()
+    assert dict(SQLiteStore(tmp_path / "tootify.db").references("twitter")) == {"1": "100", "2": "200"}
+
+
+def test_yaml_status_is_migrated_once(tmp_path):
+    path = tmp_path / "tootify.yaml"
+    feed = {"feeds": [], "template": "{title}", "status": {"references": {"https://example.com/1": "100"}}}
+    path.write_text(yaml.dump({"feed": feed, "store": {"backend": "sqlite"}}))
+    tootifier = Tootifier(path)
+    tootifier._write_status()
+    tootifier.close()
+    with path.open() as f:
+        assert "references" not in yaml.safe_load(f)["feed"]["status"]
+    tootifier = Tootifier(path)
+    assert dict(tootifier._sources["feed"].references) == {"https://example.com/1": "100"}
+    tootifier.close()
@@ -0,0 +1,256 @@
+import asyncio
+import time
+
+import pytest
+import yaml
+from mastodon import MastodonAPIError, MastodonNetworkError, MastodonServiceUnavailableError
+
+from tootify.ratelimit import PostingScheduler
+from tootify.source import Source, Toot
+from tootify.tootifier import Tootifier
+
+
+class FakeSource(Source):
+    name = "fake"
+
+    def __init__(self, config, status_path=None):
+        super().__init__(config, status_path)
+        self.posts = []
+        self.history = []
+        self.texts = {}
+
+    def connect(self):
+        pass
+
+    def get_new_posts(self):
+        posts, self.posts = self.posts, []
+        for reference, reply_to in posts:
+            toot = Toot(self, reference, self.texts.get(reference, f"Post {reference}"), reply_to)
+            toot.checkpoint = self._checkpoint(position=reference)
+            yield toot
+
+    def get_history(self, archive=None):
+        return self._backfill(
+            ((int(reference), reference) for reference in self.history),
+            lambda reference: Toot(self, reference, self.texts.get(reference, f"Post {reference}")),
+        )
+
+
+class FakeMastodon:
+    def __init__(self):
+        self.statuses = []
+        self.errors = {}
+        self.lost_responses = set()
+        self.latency = 0
+        self._idempotency_keys = {}
+
+    def status_post(self, status, in_reply_to_id=None, media_ids=None, idempotency_key=None):
+        time.sleep(self.latency)
+        if status in self.errors:
+            raise self.errors[status]
+        if idempotency_key is None or idempotency_key not in self._idempotency_keys:
+            self.statuses.append((status, in_reply_to_id))
+            self._idempotency_keys[idempotency_key] = {"id": len(self.statuses)}
+        created = self._idempotency_keys[idempotency_key]
+        if status in self.lost_responses:
+            self.lost_responses.remove(status)
+            raise MastodonNetworkError("Read timed out")
+        return created
+
+
+class FakeMediaPipeline:
+    def process(self, media):
+        return []
+
+
+@pytest.fixture
+def tootifier(tmp_path):
+    path = tmp_path / "tootify.yaml"
+    path.write_text(yaml.dump({"mastodon": {"instance": "example.com"}, "posting": {"max_attempts": 2}}))
+    tootifier = Tootifier(path)
+    tootifier._sources["fake"] = FakeSource({}, path)
+    tootifier._mastodon_api = FakeMastodon()
+    tootifier._scheduler = PostingScheduler(tootifier._mastodon_api)
+    tootifier._media_pipeline = FakeMediaPipeline()
+    return tootifier
+
+
+def run(tootifier, *posts):
+    tootifier._sources["fake"].posts = list(posts)
+    tootifier.toot()
+    return [status for status, _ in tootifier._mastodon_api.statuses]
+
+
+def test_rejected_toot_is_dropped(tootifier):
+    tootifier._mastodon_api.errors["Post 2"] = MastodonAPIError("Mastodon API returned error", 422, "", "Invalid")
+    assert run(tootifier, ("1", None), ("2", None), ("3", None)) == ["Post 1", "Post 3"]
+    assert not tootifier.config.get("pending")
+    assert run(tootifier, ("4", None)) == ["Post 1", "Post 3", "Post 4"]
+
+
+def test_failed_toot_is_retried_until_max_attempts(tootifier):
+    tootifier._mastodon_api.errors["Post 1"] = MastodonServiceUnavailableError("Unavailable")
+    assert run(tootifier, ("1", None), ("2", None)) == ["Post 2"]
+    assert [entry["attempts"] for entry in tootifier.config["pending"]] == [1]
+    assert run(tootifier, ("3", None)) == ["Post 2", "Post 3"]
+    assert not tootifier.config.get("pending")
+
+
+def test_failed_toot_is_posted_on_the_next_run(tootifier):
+    tootifier._mastodon_api.errors["Post 1"] = MastodonServiceUnavailableError("Unavailable")
+    assert run(tootifier, ("1", None)) == []
+    del tootifier._mastodon_api.errors["Post 1"]
+    assert run(tootifier) == ["Post 1"]
+    assert not tootifier.config.get("pending")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_reply_waits_for_later_parent(tootifier, workers):
+    tootifier.config["posting"]["workers"] = workers
+    run(tootifier, ("2", "1"), ("1", None), ("3", None))
+    statuses = tootifier._mastodon_api.statuses
+    assert ("Post 2", "1") in statuses
+    assert statuses.index(("Post 1", None)) < statuses.index(("Post 2", "1"))
+
+
+def test_reply_to_missing_parent_is_dropped(tootifier):
+    assert run(tootifier, ("2", "1"), ("3", None)) == ["Post 3"]
+
+
+def test_reply_stops_waiting_when_lookahead_is_full(tootifier):
+    tootifier.config["posting"]["lookahead"] = 1
+    assert run(tootifier, ("2", "1"), ("3", None), ("4", None), ("1", None)) == ["Post 3", "Post 4", "Post 1"]
+
+
+def test_concurrent_duplicates_are_posted_once(tootifier):
+    tootifier.config["dedup"] = {}
+    tootifier._open_store()
+    tootifier._mastodon_api.latency = 0.1
+    other = FakeSource({}, tootifier._status_path)
+    other.name = "other"
+    tootifier._sources["other"] = other
+    text = "The same post from two sources"
+    for source in tootifier._sources.values():
+        source.texts = {"1": text}
+        source.posts = [("1", None)]
+    asyncio.run(tootifier.toot_async())
+    assert [status for status, _ in tootifier._mastodon_api.statuses] == [text]
+    assert other.references["1"] == tootifier._sources["fake"].references["1"]
+
+
+def test_similar_posts_of_one_source_are_posted(tootifier):
+    tootifier.config["dedup"] = {}
+    tootifier._open_store()
+    text = "Our weekly newsletter is out now"
+    tootifier._sources["fake"].texts = {"1": f"{text} https://example.com/1", "2": f"{text} https://example.com/2"}
+    assert len(run(tootifier, ("1", None), ("2", None))) == 2
+
+
+def test_async_posts_are_fetched_while_posting(tootifier):
+    source = tootifier._sources["fake"]
+    posted_before_fetch = []
+
+    def get_new_posts():
+        for reference in "123":
+            posted_before_fetch.append(len(tootifier._mastodon_api.statuses))
+            yield Toot(source, reference, f"Post {reference}")
+
+    source.get_new_posts = get_new_posts
+    asyncio.run(tootifier.toot_async())
+    assert [status for status, _ in tootifier._mastodon_api.statuses] == ["Post 1", "Post 2", "Post 3"]
+    assert posted_before_fetch == [0, 1, 2]
+
+
+def test_reply_to_failed_toot_is_deferred(tootifier):
+    tootifier._mastodon_api.errors["Post 1"] = MastodonServiceUnavailableError("Unavailable")
+    assert run(tootifier, ("1", None), ("2", "1")) == []
+    assert [entry["reference"] for entry in tootifier.config["pending"]] == ["1", "2"]
+    del tootifier._mastodon_api.errors["Post 1"]
+    assert run(tootifier) == ["Post 1", "Post 2"]
+    assert tootifier._mastodon_api.statuses[1] == ("Post 2", "1")
+
+
+def test_toot_with_lost_response_is_posted_once(tootifier):
+    tootifier._mastodon_api.lost_responses.add("Post 1")
+    assert run(tootifier, ("1", None)) == ["Post 1"]
+    assert [entry["reference"] for entry in tootifier.config["pending"]] == ["1"]
+    assert run(tootifier) == ["Post 1"]
+    assert tootifier._sources["fake"].references["1"] == "1"
+
+
+def test_backfill_skips_rejected_toot(tootifier):
+    source = tootifier._sources["fake"]
+    source.history = ["1", "2", "3"]
+    tootifier._mastodon_api.errors["Post 2"] = MastodonAPIError("Mastodon API returned error", 422, "", "Too long")
+    assert tootifier.backfill("fake") == 2
+    assert "backfill" not in source.config["status"]
+    assert tootifier.backfill("fake") == 0
+    assert [status for status, _ in tootifier._mastodon_api.statuses] == ["Post 1", "Post 3"]
+
+
+def test_interrupted_backfill_is_resumed(tootifier):
+    source = tootifier._sources["fake"]
+    source.history = ["1", "2", "3"]
+    tootifier._mastodon_api.errors["Post 2"] = KeyboardInterrupt()
+    with pytest.raises(KeyboardInterrupt):
+        tootifier.backfill("fake")
+    with tootifier._status_path.open() as f:
+        assert yaml.safe_load(f)["fake"]["status"]["backfill"] == {"position": 1}
+    del tootifier._mastodon_api.errors["Post 2"]
+    assert tootifier.backfill("fake") == 2
+    assert [status for status, _ in tootifier._mastodon_api.statuses] == ["Post 1", "Post 2", "Post 3"]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_position_only_moves_past_handled_toots(tootifier, workers):
+    tootifier.config["posting"]["workers"] = workers
+    source = tootifier._sources["fake"]
+    positions = []
+    status_post = tootifier._mastodon_api.status_post
+
+    def slow_first_post(status, **kwargs):
+        if status == "Post 1":
+            time.sleep(0.2)
+        # Later toots may have been posted in the meantime, but the first one has not been handled yet
+        positions.append((status, source.config["status"].get("position")))
+        return status_post(status, **kwargs)
+
+    tootifier._mastodon_api.status_post = slow_first_post
+    tootifier._mastodon_api.errors["Post 3"] = MastodonServiceUnavailableError("Unavailable")
+    run(tootifier, ("1", None), ("2", None), ("3", None), ("4", None))
+    assert dict(positions)["Post 1"] is None
+    if workers == 1:
+        assert positions == [("Post 1", None), ("Post 2", "1"), ("Post 3", "2"), ("Post 4", "3")]
+    else:
+        assert positions[-1][0] == "Post 1"
+    assert source.config["status"]["position"] == "4"
+
+
+def test_toot_fetched_again_is_not_posted_again(tootifier):
+    assert run(tootifier, ("1", None)) == ["Post 1"]
+    # The idempotency key of the first attempt has expired
+    tootifier._mastodon_api._idempotency_keys.clear()
+    assert run(tootifier, ("1", None), ("2", None)) == ["Post 1", "Post 2"]
+
+
+def test_status_is_not_changed_while_it_is_written(tootifier, monkeypatch):
+    tootifier.config["posting"]["workers"] = 4
+    tootifier._mastodon_api.latency = 0.01
+    source = tootifier._sources["fake"]
+    source.posts = [(str(n), None) for n in range(1, 21)]
+    changed = []
+    dump = yaml.dump
+
+    def slow_dump(data, stream, Dumper):
+        references = dict(source.references)
+        time.sleep(0.02)
+        changed.append(references != source.references)
+        return dump(data, stream, Dumper)
+
+    monkeypatch.setattr(yaml, "dump", slow_dump)
+    assert tootifier.toot_source("fake") == 20
+    assert not any(changed)
+    with tootifier._status_path.open() as f:
+        status = yaml.safe_load(f)
+    assert len(status["fake"]["status"]["references"]) == 20
+    assert status["fake"]["status"]["position"] == "20"
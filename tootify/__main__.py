@@ -1,8 +1,10 @@
 import argparse
+import cProfile
 import getpass
 import logging
 from pathlib import Path
 
+from tootify.metrics import metrics
 from tootify.tootifier import Tootifier
 
 from .cli import add_verbosity_argument, configure_logger
@@ -15,16 +17,57 @@ parser.add_argument("status", type=Path)
 parser.add_argument("--dry-run", action="store_true", help="Skip everything for debugging")
 parser.add_argument("--skip", action="store_true", help="Skip tweeting (but update config)")
 parser.add_argument("--login", action="store_true", help="Ask for credentials and update status file")
+parser.add_argument("--concurrent", action="store_true", help="Connect to and fetch from all sources concurrently")
+parser.add_argument("--daemon", action="store_true", help="Keep running and poll the sources periodically")
+parser.add_argument("--metrics", type=Path, help="Write metrics to this file (JSON for .json, else Prometheus)")
+parser.add_argument("--profile", type=Path, help="Write a cProfile trace of the run to this file")
+parser.add_argument("--probe", action="store_true", help="Only connect to Mastodon if there is something to post")
+parser.add_argument("--backfill", metavar="SOURCE", help="Toot the history of this source, oldest first")
+parser.add_argument("--archive", type=Path, help="Read the history from this exported archive instead of the API")
 add_verbosity_argument(parser)
 args = parser.parse_args()
 configure_logger(args)
 
-tootifyer = Tootifier(args.status)
-if args.login:
-    instance = input("Mastodon instance: ")
-    username = input("Email used to login: ")
-    password = getpass.getpass()
-    tootifyer.login(instance, username, password, dry_run=args.dry_run)
-else:
-    tootifyer.connect()
-    tootifyer.toot(dry_run=args.dry_run, skip=args.skip)
+
+def main():
+    tootifyer = Tootifier(args.status)
+    if args.login:
+        instance = input("Mastodon instance: ")
+        username = input("Email used to login: ")
+        password = getpass.getpass()
+        tootifyer.login(instance, username, password, dry_run=args.dry_run)
+    elif args.backfill:
+        tootifyer.backfill(args.backfill, archive=args.archive, dry_run=args.dry_run, skip=args.skip)
+    elif args.daemon:
+        from tootify.daemon import Daemon
+
+        tootifyer.connect()
+        try:
+            Daemon(tootifyer, tootifyer.config.get("daemon", {})).run(dry_run=args.dry_run, skip=args.skip)
+        except KeyboardInterrupt:
+            pass
+    elif args.concurrent:
+        import asyncio
+
+        async def run():
+            await tootifyer.connect_async(probe=args.probe)
+            await tootifyer.toot_async(dry_run=args.dry_run, skip=args.skip)
+
+        asyncio.run(run())
+    else:
+        tootifyer.connect(probe=args.probe)
+        tootifyer.toot(dry_run=args.dry_run, skip=args.skip)
+
+
+try:
+    if args.profile:
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(main)
+        finally:
+            profile.dump_stats(args.profile)
+    else:
+        main()
+finally:
+    if args.metrics:
+        metrics.write(args.metrics)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _write_json(path: Path, data: Any) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: Path, default: Any) -> Any:
+    try:
+        with path.open("r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        logger.warning(f"Ignore corrupt cache index {path}")
+        return default
+
+
+class MediaCache:
+    """On-disk cache for attachments, addressed by the SHA-256 of their content.
+
+    Source URLs map to content hashes, so known URLs are not downloaded again. Uploads that have not been
+    attached to a status are remembered per content hash, so they can be attached when the same file is tooted again.
+    Blobs are evicted in least recently used order once the cache exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, path: Path, max_size: int = 256 * 2**20) -> None:
+        self._path = path
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._index_path = self._path / "index.json"
+        self._lock = threading.Lock()
+        self._index = _read_json(self._index_path, {"urls": {}, "uploads": {}})
+        self._dirty = False
+        if "size" not in self._index:
+            # The total size of all blobs is kept in the index, so it is only summed up for new caches
+            self._index["size"] = sum(stat.st_size for stat, _ in self._blobs())
+            self._dirty = True
+
+    def _blob_path(self, digest: str) -> Path:
+        return self._path / digest[:2] / digest
+
+    def _blobs(self):
+        return [
+            (blob_path.stat(), blob_path)
+            for blob_path in self._path.glob("*/*")
+            if blob_path.is_file() and not blob_path.name.endswith(".tmp")
+        ]
+
+    def get(self, url: str) -> Optional[Tuple[Path, str, str]]:
+        """Return the path of the cached file, its MIME type and its hash."""
+        with self._lock:
+            entry = self._index["urls"].get(url)
+        if entry is None:
+            return None
+        blob_path = self._blob_path(entry["hash"])
+        try:
+            os.utime(blob_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._index["urls"].pop(url, None)
+                self._dirty = True
+            return None
+        logger.debug(f"Cache hit for {url}")
+        return blob_path, entry["mime_type"], entry["hash"]
+
+    def put(self, url: str, file: BinaryIO, mime_type: str) -> str:
+        """Copy ``file`` into the cache in chunks and rewind it."""
+        hash = hashlib.sha256()
+        size = 0
+        tmp_path = self._path / f"{threading.get_ident()}.tmp"
+        with tmp_path.open("wb") as tmp_file:
+            for chunk in iter(lambda: file.read(2**16), b""):
+                hash.update(chunk)
+                size += tmp_file.write(chunk)
+        file.seek(0)
+        digest = hash.hexdigest()
+        blob_path = self._blob_path(digest)
+        with self._lock:
+            if blob_path.exists():
+                tmp_path.unlink()
+                os.utime(blob_path)
+            else:
+                blob_path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_path, blob_path)
+                self._index["size"] += size
+            self._index["urls"][url] = {"hash": digest, "mime_type": mime_type}
+            self._dirty = True
+            if self._index["size"] > self._max_size:
+                self._evict()
+        return digest
+
+    def take_upload(self, digest: str, key: str, max_age: float) -> Optional[Dict[str, Any]]:
+        """Remove and return an upload younger than ``max_age`` seconds, so its media ID is only used once."""
+        with self._lock:
+            uploads = self._index["uploads"].get(digest, {})
+            entry = uploads.pop(key, None)
+            if entry is None:
+                return None
+            if not uploads:
+                self._index["uploads"].pop(digest)
+            self._dirty = True
+        if time.time() - entry["time"] < max_age:
+            logger.debug(f"Reuse upload {entry['id']}")
+            return entry
+        return None
+
+    def put_upload(self, digest: str, key: str, id: Any, uploaded: Optional[float] = None) -> None:
+        """Remember an upload that has not been attached to a status."""
+        with self._lock:
+            self._index["uploads"].setdefault(digest, {})[key] = {"id": id, "time": uploaded or time.time()}
+            self._dirty = True
+
+    def _evict(self) -> None:
+        # Called with the lock held. The blobs are only listed once the running total exceeds the limit, which also
+        # corrects the total if blobs have been removed from outside.
+        blobs = self._blobs()
+        size = sum(stat.st_size for stat, _ in blobs)
+        evicted = set()
+        for stat, blob_path in sorted(blobs, key=lambda blob: blob[0].st_mtime):
+            if size <= self._max_size:
+                break
+            logger.debug(f"Evict {blob_path.name} from media cache")
+            blob_path.unlink(missing_ok=True)
+            size -= stat.st_size
+            evicted.add(blob_path.name)
+        self._index["size"] = size
+        self._index["urls"] = {url: entry for url, entry in self._index["urls"].items() if entry["hash"] not in evicted}
+        for digest in evicted:
+            self._index["uploads"].pop(digest, None)
+        self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if self._dirty:
+                _write_json(self._index_path, self._index)
+                self._dirty = False
+
+
+class TTLCache:
+    """Persistent key-value cache whose entries expire ``ttl`` seconds after they were stored."""
+
+    def __init__(self, path: Optional[Path], ttl: float) -> None:
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        now = time.time()
+        entries = _read_json(path, {}) if path else {}
+        self._entries = {key: entry for key, entry in entries.items() if now - entry["time"] < ttl}
+        self._dirty = len(self._entries) != len(entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and time.time() - entry["time"] < self._ttl:
+            return entry["value"]
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = {"value": value, "time": time.time()}
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if self._path and self._dirty:
+                _write_json(self._path, self._entries)
+                self._dirty = False
@@ -0,0 +1,94 @@
+import heapq
+import logging
+import random
+import signal
+import threading
+import time
+from typing import Any, Dict
+
+from tootify.tootifier import Tootifier
+
+logger = logging.getLogger(__name__)
+
+
+class Schedule:
+    """Polling interval of a single source.
+
+    The interval shrinks while the source has new posts and grows while it is quiet. After errors, the source is
+    retried with an exponential, jittered backoff.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, max_backoff: float) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.interval = min_interval
+        self.failures = 0
+
+    def success(self, count: int) -> float:
+        self.failures = 0
+        if count:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        return self.interval * random.uniform(0.9, 1.1)
+
+    def failure(self) -> float:
+        self.failures += 1
+        return min(self.max_backoff, self.min_interval * 2**self.failures) * random.uniform(0.5, 1.5)
+
+
+class Daemon:
+    """Keep a connected ``Tootifier`` running and poll each source on its own schedule.
+
+    Sources are connected again every ``reconnect_interval`` seconds and after a failed poll, so access tokens are
+    refreshed before they expire.
+    """
+
+    def __init__(self, tootifier: Tootifier, config: Dict[str, Any] = {}) -> None:
+        self._tootifier = tootifier
+        self._schedules = {
+            name: Schedule(
+                min_interval=config.get("min_interval", 60),
+                max_interval=config.get("max_interval", 3600),
+                max_backoff=config.get("max_backoff", 3600),
+            )
+            for name in tootifier.sources
+        }
+        self._reconnect_interval = config.get("reconnect_interval", 24 * 60 * 60)
+        # Time of the last connection of each source, None if it has to be connected before the next poll
+        self._connected = {name: time.monotonic() for name in tootifier.sources}
+        self._stopped = threading.Event()
+
+    def stop(self, *args) -> None:
+        logger.info("Stop daemon")
+        self._stopped.set()
+
+    def _reconnect(self, name: str) -> None:
+        connected = self._connected[name]
+        if connected is not None and time.monotonic() - connected < self._reconnect_interval:
+            return
+        logger.info(f"Reconnect {name}")
+        self._tootifier.connect_source(name)
+        self._connected[name] = time.monotonic()
+
+    def run(self, dry_run: bool = False, skip: bool = False) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        queue = [(time.monotonic(), name) for name in self._schedules]
+        heapq.heapify(queue)
+        while queue and not self._stopped.is_set():
+            due, name = heapq.heappop(queue)
+            if self._stopped.wait(max(0, due - time.monotonic())):
+                break
+            schedule = self._schedules[name]
+            try:
+                self._reconnect(name)
+                count = self._tootifier.toot_source(name, dry_run=dry_run, skip=skip)
+                delay = schedule.success(count)
+                logger.info(f"Found {count} new posts in {name}, next poll in {delay:.0f}s")
+            except Exception as e:
+                # The error may be an expired token, which is refreshed by connecting again
+                self._connected[name] = None
+                delay = schedule.failure()
+                logger.error(f"Failed to poll {name}, retry in {delay:.0f}s: {e}")
+            heapq.heappush(queue, (time.monotonic() + delay, name))
@@ -0,0 +1,229 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+URL_PATTERN = re.compile(r"https?://\S+")
+# Handles are rewritten differently per source (@name@twitter.com, @name@instagram.com), so the domain is dropped
+HANDLE_PATTERN = re.compile(r"@(\w+)@[\w.-]+")
+WORD_PATTERN = re.compile(r"\w+")
+
+BITS = 64
+
+
+def normalize(text: str) -> List[str]:
+    """Return the words of a toot without URLs, case, accents and punctuation."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = HANDLE_PATTERN.sub(r"\1", URL_PATTERN.sub(" ", text))
+    return WORD_PATTERN.findall(text)
+
+
+def _hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=BITS // 8).digest(), "big")
+
+
+def simhash(words: List[str]) -> int:
+    """64 bit SimHash of the words and word pairs. Similar texts have hashes with a small Hamming distance."""
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    weights = [0] * BITS
+    for feature in features:
+        value = _hash(feature)
+        for bit in range(BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(BITS) if weights[bit] > 0)
+
+
+def dhash(file: BinaryIO) -> Optional[int]:
+    """64 bit difference hash of an image, which survives resizing and recompression. Requires Pillow."""
+    from PIL import Image
+
+    try:
+        with Image.open(file) as image:
+            image.draft("L", (64, 64))
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.debug(f"Could not hash image: {e}")
+        return None
+    finally:
+        file.seek(0)
+    return sum(
+        1 << (row * 8 + column)
+        for row in range(8)
+        for column in range(8)
+        if pixels[row * 9 + column] > pixels[row * 9 + column + 1]
+    )
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class _BandIndex:
+    """Find hashes within ``max_distance`` bits without comparing against every entry.
+
+    The hashes are split into ``max_distance + 1`` bands. Two hashes that differ in at most ``max_distance`` bits
+    must be equal in at least one band, so only entries sharing a band are compared.
+    """
+
+    def __init__(self, max_distance: int) -> None:
+        self._max_distance = max_distance
+        bands = max_distance + 1
+        width = BITS // bands
+        self._bands = [(band * width, BITS if band == bands - 1 else (band + 1) * width) for band in range(bands)]
+        self._buckets = defaultdict(list)
+
+    def _keys(self, value: int):
+        for band, (start, end) in enumerate(self._bands):
+            yield band, value >> start & ((1 << (end - start)) - 1)
+
+    def add(self, value: int, entry: Dict[str, Any]) -> None:
+        for key in self._keys(value):
+            self._buckets[key].append((value, entry))
+
+    def remove(self, value: int, entry: Dict[str, Any]) -> None:
+        for key in self._keys(value):
+            self._buckets[key] = [item for item in self._buckets[key] if item[1] is not entry]
+
+    def find(self, value: int) -> List[Dict[str, Any]]:
+        found = {}
+        for key in self._keys(value):
+            for candidate, entry in self._buckets[key]:
+                if distance(value, candidate) <= self._max_distance:
+                    found[id(entry)] = entry
+        return list(found.values())
+
+
+class YAMLFingerprints:
+    """Fingerprints kept in a list of the YAML status."""
+
+    def __init__(self, entries: List[Dict[str, Any]]) -> None:
+        self._entries = entries
+
+    def load(self, since: float) -> List[Dict[str, Any]]:
+        self._entries[:] = [entry for entry in self._entries if entry["time"] >= since]
+        return list(self._entries)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        self._entries.append(entry)
+
+
+class DuplicateIndex:
+    """Fingerprints of recent toots from all sources, to find the same post arriving through several sources.
+
+    A toot is a duplicate of an earlier toot of another source if its text has a SimHash within ``max_distance`` bits,
+    or if all of its images have a difference hash within ``media_distance`` bits of an image of the same earlier
+    toot. Texts shorter than ``min_words`` are only compared by their images. Only toots of the last ``window``
+    seconds are kept.
+
+    Toots are posted concurrently, so finding a duplicate and adding the fingerprints of a new toot happen in one step
+    with ``reserve``. The reservation is confirmed with the ID of the posted toot, or released if posting failed.
+    """
+
+    def __init__(
+        self,
+        store,
+        window: float = 7 * 24 * 60 * 60,
+        max_distance: int = 3,
+        media_distance: int = 6,
+        min_words: int = 4,
+    ) -> None:
+        self._store = store
+        self._window = window
+        self._min_words = min_words
+        # Notified whenever a reservation is confirmed or released
+        self._lock = threading.Condition()
+        self._texts = _BandIndex(max_distance)
+        self._media = _BandIndex(media_distance)
+        for entry in store.load(time.time() - window):
+            self._index(entry)
+
+    def _index(self, entry: Dict[str, Any]) -> None:
+        if entry.get("text"):
+            self._texts.add(int(entry["text"], 16), entry)
+        for media_hash in entry.get("media", []):
+            self._media.add(int(media_hash, 16), entry)
+
+    def _unindex(self, entry: Dict[str, Any]) -> None:
+        if entry.get("text"):
+            self._texts.remove(int(entry["text"], 16), entry)
+        for media_hash in entry.get("media", []):
+            self._media.remove(int(media_hash, 16), entry)
+
+    def _recent(self, entries: List[Dict[str, Any]], source: str) -> List[Dict[str, Any]]:
+        # Posts of the same source are never duplicates of each other, e.g. recurring newsletters of a feed
+        since = time.time() - self._window
+        return sorted(
+            (entry for entry in entries if entry["time"] >= since and entry["source"] != source),
+            key=lambda entry: entry["time"],
+        )
+
+    def text_hash(self, text: str) -> Optional[int]:
+        words = normalize(text)
+        return simhash(words) if len(words) >= self._min_words else None
+
+    def _find(
+        self, text_hash: Optional[int], media_hashes: List[Optional[int]], source: str
+    ) -> Optional[Dict[str, Any]]:
+        if text_hash is not None:
+            matches = self._recent(self._texts.find(text_hash), source)
+            if matches:
+                return matches[0]
+        if media_hashes and None not in media_hashes:
+            candidates = [{id(entry): entry for entry in self._media.find(value)} for value in media_hashes]
+            common = set.intersection(*(set(candidate) for candidate in candidates))
+            matches = self._recent([candidates[0][key] for key in common], source)
+            if matches:
+                return matches[0]
+        return None
+
+    def find(
+        self, text_hash: Optional[int], media_hashes: List[Optional[int]], source: str
+    ) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            duplicate = self._find(text_hash, media_hashes, source)
+        # A duplicate that is still being posted is only known for sure once it has been confirmed
+        return duplicate if duplicate is not None and duplicate["id"] is not None else None
+
+    def reserve(
+        self, text_hash: Optional[int], media_hashes: List[Optional[int]], source: str
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Return the earlier toot that is duplicated, or reserve the fingerprints for a new toot.
+
+        If the duplicate is still being posted, wait until its reservation is confirmed or released. Returns the
+        duplicate and the reservation, one of which is ``None``.
+        """
+        with self._lock:
+            while True:
+                duplicate = self._find(text_hash, media_hashes, source)
+                if duplicate is None:
+                    break
+                if duplicate["id"] is not None:
+                    return duplicate, None
+                self._lock.wait()
+            entry = {
+                "time": time.time(),
+                "text": None if text_hash is None else f"{text_hash:016x}",
+                "media": [f"{value:016x}" for value in media_hashes if value is not None],
+                "id": None,
+                "source": source,
+            }
+            self._index(entry)
+            return None, entry
+
+    def confirm(self, entry: Dict[str, Any], id: str) -> None:
+        with self._lock:
+            entry["id"] = id
+            self._store.add(entry)
+            self._lock.notify_all()
+
+    def release(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._unindex(entry)
+            self._lock.notify_all()
@@ -1,52 +1,127 @@
 from datetime import datetime
 import logging
 import re
-from typing import List
-
-import dateparser
-import feedparser
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import List, Optional
 
 from tootify.source import Media, Source, Toot
 
 logger = logging.getLogger(__name__)
 
 
+def _parse_published(entry) -> datetime:
+    published = entry["published"]
+    # Most feeds use RFC 822 (RSS) or ISO 8601 (Atom), both are much cheaper to parse than with dateparser
+    try:
+        return parsedate_to_datetime(published).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(published.replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+        pass
+    if entry.get("published_parsed"):
+        return datetime(*entry["published_parsed"][:6])
+    import dateparser
+
+    return dateparser.parse(published).replace(tzinfo=None)
+
+
 class FeedSource(Source):
+    name = "feed"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._patterns = {}
+
+    def _pattern(self, feed) -> re.Pattern:
+        pattern = feed.get("pattern", ".*")
+        if pattern not in self._patterns:
+            self._patterns[pattern] = re.compile(pattern)
+        return self._patterns[pattern]
+
     def connect(self):
         pass
 
+    def _fetch(self, feed):
+        import feedparser
+
+        # Send a conditional request, unchanged feeds are answered with 304 and an empty body
+        parser = feedparser.parse(feed["url"], etag=feed.get("etag"), modified=feed.get("modified"))
+        if parser.get("status") == 304:
+            logger.debug(f'Feed {feed["url"]} did not change')
+            return None
+        if parser.get("etag"):
+            feed["etag"] = parser.etag
+        if parser.get("modified"):
+            feed["modified"] = parser.modified
+        return parser
+
     def get_new_posts(self) -> List[Toot]:
         result = []
-        for feed in self.config["feeds"]:
-            parser = feedparser.parse(feed["url"])
+        with ThreadPoolExecutor(max_workers=self.config.get("workers", 8)) as executor:
+            parsers = list(executor.map(self._fetch, self.config["feeds"]))
+        for feed, parser in zip(self.config["feeds"], parsers):
+            if parser is None:
+                continue
             last_update = feed.get("last_update", None) and datetime.fromisoformat(
                 feed.get("last_update", None)
             ).replace(tzinfo=None)
             last_update_new = last_update
+            pattern = self._pattern(feed)
             for entry in parser.entries:
-                if not re.search(feed.get("pattern", ".*"), entry["description"]):
-                    logger.info(f'Did not match: {feed.get("pattern", ".*")}')
+                published_parsed = None
+                if feed.get("ordered", False):
+                    # Entries of ordered feeds are sorted newest first, so everything after this one is old
+                    published_parsed = _parse_published(entry)
+                    if last_update is not None and published_parsed <= last_update:
+                        logger.debug(f'Stop reading {feed["url"]} at {entry["id"]}')
+                        break
+                if not pattern.search(entry["description"]):
+                    logger.info(f"Did not match: {pattern.pattern}")
                     continue
-                published_parsed = dateparser.parse(entry["published"]).replace(tzinfo=None)
+                published_parsed = published_parsed or _parse_published(entry)
                 if last_update is None or published_parsed > last_update:
                     last_update_new = (
                         max(filter(None, (last_update_new, published_parsed)))
                         if last_update_new
                         else published_parsed
                     )
-                    if entry["id"] in self.config["status"]["references"]:
+                    if entry["id"] in self.references:
                         logger.warning(f'Skip {entry["id"]} because entry has been redated.')
                         continue
-                    result.append(
-                        Toot(
-                            source=self,
-                            reference=entry["id"],
-                            status=self.config["template"].format(
-                                title=entry["title"],
-                                description=entry["description"],
-                                link=entry["link"],
-                            ),
-                        )
-                    )
+                    result.append(self._entry_toot(entry))
             feed["last_update"] = last_update_new and last_update_new.isoformat()
         return result
+
+    def _entry_toot(self, entry) -> Toot:
+        return Toot(
+            source=self,
+            reference=entry["id"],
+            status=self.config["template"].format(
+                title=entry["title"], description=entry["description"], link=entry["link"]
+            ),
+        )
+
+    def get_history(self, archive: Optional[Path] = None):
+        import feedparser
+
+        if archive:
+            # An exported feed file, e.g. from the blog software, with all entries
+            posts = [(_parse_published(entry), entry) for entry in feedparser.parse(str(archive)).entries]
+        else:
+            # Feeds only contain their latest entries, but some of them may be older than the first run
+            posts = []
+            for feed in self.config["feeds"]:
+                if not feed.get("last_update"):
+                    continue
+                last_update = datetime.fromisoformat(feed["last_update"]).replace(tzinfo=None)
+                pattern = self._pattern(feed)
+                for entry in feedparser.parse(feed["url"]).entries:
+                    published = _parse_published(entry)
+                    if published <= last_update and pattern.search(entry["description"]):
+                        posts.append((published, entry))
+        logger.info(f"Found {len(posts)} entries to backfill")
+        yield from self._backfill(posts, self._entry_toot)
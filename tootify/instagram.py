@@ -1,8 +1,8 @@
 import datetime
+import json
 import logging
-import re
-
-from instagram_basic_display.InstagramBasicDisplay import InstagramBasicDisplay
+from pathlib import Path
+from typing import Optional
 
 from tootify.source import Media, Source, Toot
 
@@ -10,43 +10,41 @@ logger = logging.getLogger(__name__)
 
 
 class IGSource(Source):
+    name = "instagram"
+    handle_domain = "instagram.com"
+    handle_length = 30
+
     def _parse_timestamp(self, timestamp):
         return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
 
-    def _expand_handles(self, text: str):
-        handles = re.findall("(?<=[^0-9a-zA-Z_])@[0-9a-zA-Z_]{1,30}(?=[^0-9a-zA-Z_@]|$)", text)
-        familiar_accounts = self.config.get("familiar_accounts", {})
-        for handle in handles:
-            if handle[1:] in familiar_accounts:
-                logger.debug(f"Found {handle} in familiar accounts: {familiar_accounts[handle[1:]]}")
-                text = text.replace(handle, f"@{familiar_accounts[handle[1:]]}")
-            else:
-                text = text.replace(handle, f"{handle}@instagram.com")
-        return text
-
-    def _translate_hashtags(self, text: str) -> str:
-        result = text
-        for hashtag, replacement in self.config.get("common_hashtags", {}).items():
-            result = re.sub(f"{re.escape(hashtag)}(?=[^0-9a-zA-Z_@]|$)", replacement, result)
-        return result
+    def _children(self, post):
+        # Children are only loaded for posts that are actually tooted
+        if "children" not in post:
+            post["children"] = self._instagram_basic_display.get_media_children(post["id"])
+        return post["children"]["data"]
 
     def tootify(self, post):
         media = []
         if post["media_type"] == "IMAGE":
             media = [Media(post["media_url"])]
         elif post["media_type"] == "CAROUSEL_ALBUM":
-            media = [Media(media["media_url"]) for media in post["children"]["data"][: self.config.get("max_media", 4)]]
+            media = [Media(media["media_url"]) for media in self._children(post)[: self.config.get("max_media", 4)]]
         else:
             logger.error(f'Skip unknown media type {post["media_type"]}')
             return None
-        caption = self._translate_hashtags(self._expand_handles(post["caption"]))
+        caption = self.rewriter.rewrite(post["caption"])
         return Toot(source=self, reference=post["id"], status=caption, media=media)
 
     def connect(self):
+        from instagram_basic_display.InstagramBasicDisplay import InstagramBasicDisplay
+
         self._instagram_basic_display = InstagramBasicDisplay(
             app_id=self.config["app_id"], app_secret=self.config["app_secret"], redirect_url="https://example.com/"
         )
         self._instagram_basic_display.set_access_token(self.config["access_token"])
+        self._instagram_basic_display.set_media_fields(
+            "caption, id, media_type, media_url, permalink, thumbnail_url, timestamp, username"
+        )
         self._user_profile = self._instagram_basic_display.get_user_profile()
         logger.info(f'connected to @{self._user_profile["username"]}@instagram.com')
         expires_in = self.config.get("expires_at", datetime.datetime.now()) - datetime.datetime.now()
@@ -57,17 +55,77 @@ class IGSource(Source):
             self.config["access_token"] = refresh["access_token"]
             self.config["expires_at"] = datetime.datetime.now() + datetime.timedelta(seconds=refresh["expires_in"])
 
+    def _get_posts_since(self, last_update, all_pages: bool = False):
+        page = self._instagram_basic_display.get_user_media()
+        while page:
+            for post in page.get("data", []):
+                timestamp = self._parse_timestamp(post["timestamp"])
+                # Posts are sorted newest first, so everything after this one has been tooted already
+                if last_update and timestamp <= last_update:
+                    return
+                yield timestamp, post
+            # Without last_update, only the latest page is read, so the first run does not toot everything
+            if not (last_update or all_pages):
+                return
+            page = self._instagram_basic_display.pagination(page) if page.get("paging") else None
+
     def get_new_posts(self):
         last_update = self.config.get("status", {}).get("last_update", None)
-        new_posts = self._instagram_basic_display.get_user_media()["data"]
-        if last_update:
-            new_posts = [
-                post
-                for post in new_posts
-                if self._parse_timestamp(post["timestamp"]) > self._parse_timestamp(last_update)
-            ]
-        if new_posts:
-            self.config["status"]["last_update"] = max(
-                new_posts, key=lambda post: self._parse_timestamp(post["timestamp"])
-            )["timestamp"]
-        return filter(None, [self.tootify(post) for post in new_posts])
+        new_posts = sorted(
+            self._get_posts_since(last_update and self._parse_timestamp(last_update)), key=lambda item: item[0]
+        )
+        for _, post in new_posts:
+            toot = self.tootify(post)
+            # Toots are fetched ahead of posting, so the position only moves on once the toot has been handled. Posts
+            # that are not tooted are covered by the checkpoint of the next toot, or read again next time.
+            if toot:
+                toot.checkpoint = self._checkpoint(last_update=post["timestamp"])
+                yield toot
+
+    @staticmethod
+    def _fix_encoding(text: str) -> str:
+        # Instagram exports UTF-8 text escaped as if it were Latin-1
+        try:
+            return text.encode("latin-1").decode("utf-8")
+        except UnicodeError:
+            return text
+
+    def _archive_toot(self, archive: Path, post) -> Toot:
+        caption = self._fix_encoding(post.get("title") or post["media"][0].get("title", ""))
+        return Toot(
+            source=self,
+            # The archive has no media IDs, so posts are referenced by their time
+            reference=f"archive-{post['creation_timestamp']}",
+            status=self.rewriter.rewrite(caption),
+            media=[Media((archive / media["uri"]).resolve().as_uri()) for media in post["media"]][
+                : self.config.get("max_media", 4)
+            ],
+        )
+
+    def get_history(self, archive: Optional[Path] = None):
+        last_update = self.config["status"].get("last_update")
+        if last_update is None:
+            raise ValueError("Run once with --skip before backfilling, so new posts are not tooted twice")
+        last_update = self._parse_timestamp(last_update)
+        if archive:
+            posts = [post for path in sorted(archive.glob("**/posts_*.json")) for post in json.loads(path.read_text())]
+            logger.info(f"Found {len(posts)} posts in {archive}")
+            for post in posts:
+                post.setdefault("creation_timestamp", post["media"][0]["creation_timestamp"])
+            timestamped = (
+                (datetime.datetime.fromtimestamp(post["creation_timestamp"], datetime.timezone.utc), post)
+                for post in posts
+            )
+            yield from self._backfill(
+                ((timestamp, post) for timestamp, post in timestamped if timestamp <= last_update),
+                lambda post: self._archive_toot(archive, post),
+            )
+            return
+        position = self.config["status"].get("backfill", {}).get("position")
+        posts = [
+            (timestamp, post)
+            for timestamp, post in self._get_posts_since(None, all_pages=True)
+            if timestamp <= last_update and (position is None or timestamp >= position)
+        ]
+        logger.info(f"Found {len(posts)} posts to backfill")
+        yield from self._backfill(posts, self.tootify)
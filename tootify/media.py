@@ -0,0 +1,335 @@
+import importlib.util
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tootify.cache import MediaCache
+from tootify.dedup import dhash
+from tootify.metrics import metrics
+from tootify.ratelimit import PostingScheduler
+from tootify.source import Media
+
+logger = logging.getLogger(__name__)
+
+# Limits of a standard Mastodon 4 instance, used if the instance does not report its own
+DEFAULT_LIMITS = {"image_size_limit": 16 * 2**20, "image_matrix_limit": 33_177_600, "video_size_limit": 99 * 2**20}
+
+
+def optimize_image(content: bytes, size_limit: int, matrix_limit: int) -> Tuple[bytes, str]:
+    """Downscale an image to at most ``matrix_limit`` pixels and recompress it to fit ``size_limit`` bytes.
+
+    Images that do not fit even at the lowest quality are downscaled further. This runs in a worker process and
+    requires Pillow.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(content)) as original:
+        image = ImageOps.exif_transpose(original)
+        pixels = image.width * image.height
+        if pixels > matrix_limit:
+            scale = (matrix_limit / pixels) ** 0.5
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P") and original.format == "PNG":
+            buffer = BytesIO()
+            image.save(buffer, "PNG", optimize=True)
+            if buffer.tell() <= size_limit:
+                return buffer.getvalue(), "image/png"
+        image = image.convert("RGB")
+        while True:
+            for quality in (90, 80, 70, 60, 50):
+                buffer = BytesIO()
+                image.save(buffer, "JPEG", quality=quality, optimize=True)
+                if buffer.tell() <= size_limit:
+                    return buffer.getvalue(), "image/jpeg"
+            if image.width == 1 and image.height == 1:
+                raise MediaTooLarge(f"The image does not fit {size_limit} bytes")
+            # The size of a JPEG grows about linearly with the number of pixels
+            scale = min(0.9, (size_limit / buffer.tell()) ** 0.5)
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+
+class MediaTooLarge(ValueError):
+    pass
+
+
+def _size(file: BinaryIO) -> int:
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    return size
+
+
+class MediaResult:
+    def __init__(
+        self,
+        media: Media,
+        id: Optional[Any] = None,
+        error: Optional[Exception] = None,
+        fingerprint: Optional[int] = None,
+        reusable: Optional[Tuple[str, str, float]] = None,
+    ) -> None:
+        self.media = media
+        self.id = id
+        self.error = error
+        self.fingerprint = fingerprint
+        # Content hash, cache key and time of an upload that can be reused if it is not attached to a status
+        self.reusable = reusable
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return f"MediaResult({repr(self.media)}, {repr(self.id)}, {repr(self.error)})"
+
+
+class MediaPipeline:
+    """Download attachments and upload them to Mastodon using a bounded pool of workers.
+
+    All downloads share one keep-alive session. Results are returned in the order of the input. With a ``cache``,
+    known URLs are not downloaded again and, if ``reuse_uploads`` is set, uploads of identical content younger than
+    ``reuse_uploads`` seconds are reused for the account given by ``namespace``. Mastodon only accepts media IDs that
+    have not been attached to a status, so only uploads passed to ``release`` are reused.
+
+    Before the upload, the best video variant within the ``limits`` of the instance is chosen. With ``optimize``,
+    images that exceed the limits are downscaled and recompressed in a pool of ``optimize_workers`` processes.
+
+    Downloads are streamed into temporary files that stay in memory up to ``spool_size`` bytes. Files larger than the
+    limits of the instance or ``max_download_size`` are rejected as soon as their size is known.
+
+    With ``fingerprint``, a perceptual hash of every image is computed for the duplicate detection.
+
+    Videos are processed by the instance after the upload. Their upload only completes once they have been processed,
+    or fails after ``processing_timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        mastodon_api,
+        max_workers: int = 4,
+        timeout: float = 30,
+        cache: Optional[MediaCache] = None,
+        namespace: Optional[str] = None,
+        reuse_uploads: float = 0,
+        scheduler: Optional[PostingScheduler] = None,
+        limits: Dict[str, int] = {},
+        optimize: bool = True,
+        optimize_workers: int = 2,
+        spool_size: int = 2**20,
+        max_download_size: int = 100 * 2**20,
+        fingerprint: bool = False,
+        processing_timeout: float = 300,
+    ) -> None:
+        self._mastodon_api = mastodon_api
+        self._limits = {**DEFAULT_LIMITS, **limits}
+        self._optimize = optimize and importlib.util.find_spec("PIL") is not None
+        if optimize and not self._optimize:
+            logger.info("Install Pillow to optimize images before the upload")
+        self._optimize_workers = optimize_workers
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        self._spool_size = spool_size
+        self._max_download_size = max_download_size
+        self._fingerprint = fingerprint and importlib.util.find_spec("PIL") is not None
+        self._scheduler = scheduler
+        self._timeout = timeout
+        self._processing_timeout = processing_timeout
+        self._cache = cache
+        self._namespace = namespace
+        self._reuse_uploads = reuse_uploads if namespace else 0
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tootify-media")
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    def _select_variant(self, media: Media) -> str:
+        """Return the URL of the variant with the highest bit rate that fits the video size limit."""
+        if len(media.variants) < 2:
+            return media.media_url
+        for variant in media.variants:
+            if self._cache and self._cache.get(variant["url"]):
+                return variant["url"]
+            response = self._session.head(variant["url"], timeout=self._timeout, allow_redirects=True)
+            if response.ok and int(response.headers.get("content-length") or 0) <= self._limits["video_size_limit"]:
+                return variant["url"]
+        logger.warning(f"No variant of {media.media_url} fits the size limit, use the smallest")
+        return media.variants[-1]["url"]
+
+    def _max_size(self, mime_type: str) -> int:
+        if mime_type.startswith("video/"):
+            limit = self._limits["video_size_limit"]
+        elif mime_type.startswith("image/") and not (self._optimize and mime_type != "image/gif"):
+            limit = self._limits["image_size_limit"]
+        else:
+            # Oversized images can still be downscaled
+            limit = self._max_download_size
+        return min(limit, self._max_download_size)
+
+    def _open_file(self, url: str) -> Tuple[BinaryIO, str, Optional[str]]:
+        # Local files, e.g. from an archive, are uploaded directly
+        path = url2pathname(urlsplit(url).path)
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        max_size = self._max_size(mime_type)
+        if os.path.getsize(path) > max_size:
+            raise MediaTooLarge(f"{path} has {os.path.getsize(path)} bytes, the limit is {max_size}")
+        return open(path, "rb"), mime_type, None
+
+    def _download(self, url: str) -> Tuple[BinaryIO, str, Optional[str]]:
+        if url.startswith("file:"):
+            return self._open_file(url)
+        if self._cache:
+            cached = self._cache.get(url)
+            if cached:
+                path, mime_type, digest = cached
+                # The limits may be lower than when the file was cached, e.g. for another instance
+                size, max_size = path.stat().st_size, self._max_size(mime_type)
+                if size > max_size:
+                    raise MediaTooLarge(f"{url} has {size} bytes, the limit is {max_size}")
+                return path.open("rb"), mime_type, digest
+        logger.debug(f"Download {url}")
+        with metrics.timer("media_download"), self._session.get(url, stream=True, timeout=self._timeout) as response:
+            response.raise_for_status()
+            mime_type = response.headers["content-type"]
+            max_size = self._max_size(mime_type)
+            if int(response.headers.get("content-length") or 0) > max_size:
+                raise MediaTooLarge(f"{url} has {response.headers['content-length']} bytes, the limit is {max_size}")
+            file = SpooledTemporaryFile(max_size=self._spool_size)
+            try:
+                for chunk in response.iter_content(2**16):
+                    file.write(chunk)
+                    if file.tell() > max_size:
+                        raise MediaTooLarge(f"{url} exceeds the limit of {max_size} bytes")
+                file.seek(0)
+                digest = self._cache.put(url, file, mime_type) if self._cache else None
+            except BaseException:
+                file.close()
+                raise
+        return file, mime_type, digest
+
+    def _exceeds_limits(self, file: BinaryIO, mime_type: str) -> bool:
+        if not mime_type.startswith("image/") or mime_type == "image/gif":
+            return False
+        if _size(file) > self._limits["image_size_limit"]:
+            return True
+        from PIL import Image
+
+        try:
+            # Only the header is read here
+            with Image.open(file) as image:
+                return image.width * image.height > self._limits["image_matrix_limit"]
+        except Exception:
+            return False
+        finally:
+            file.seek(0)
+
+    def _optimize_image(self, file: BinaryIO, mime_type: str) -> Tuple[BinaryIO, str]:
+        if not self._optimize or not self._exceeds_limits(file, mime_type):
+            return file, mime_type
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # Forking a process with running threads can copy locks that are held by other threads
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self._optimize_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+        size = _size(file)
+        try:
+            with metrics.timer("media_optimize"):
+                optimized, optimized_type = self._process_pool.submit(
+                    optimize_image, file.read(), self._limits["image_size_limit"], self._limits["image_matrix_limit"]
+                ).result()
+        except MediaTooLarge:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not optimize image, upload it unchanged: {e}")
+            file.seek(0)
+            return file, mime_type
+        logger.debug(f"Optimized image from {size} to {len(optimized)} bytes")
+        metrics.count("bytes_saved", value=size - len(optimized))
+        return BytesIO(optimized), optimized_type
+
+    def _upload(
+        self, media: Media, file: BinaryIO, mime_type: str, digest: Optional[str]
+    ) -> Tuple[Any, Optional[Tuple[str, str, float]]]:
+        upload_key = f"{self._namespace}\n{media.description or ''}"
+        reusable = bool(digest and self._reuse_uploads)
+        if reusable:
+            entry = self._cache.take_upload(digest, upload_key, self._reuse_uploads)
+            if entry is not None:
+                return entry["id"], (digest, upload_key, entry["time"])
+        uploaded = time.time()
+        size = _size(file)
+        logger.debug(f"Upload {media.media_url} ({size} bytes)")
+
+        def upload():
+            # Retries after a rate limit have to send the file from the start again
+            file.seek(0)
+            return self._mastodon_api.media_post(file, mime_type=mime_type, description=media.description)
+
+        with metrics.timer("media_upload"):
+            attachment = self._scheduler.media(upload) if self._scheduler else upload()
+        metrics.count("bytes_uploaded", value=size)
+        if attachment.get("url") is None:
+            # The instance accepted the upload with 202, but rejects statuses with attachments still being processed
+            with metrics.timer("media_processing"):
+                self._wait_for_processing(attachment["id"])
+        return attachment["id"], (digest, upload_key, uploaded) if reusable else None
+
+    def _wait_for_processing(self, id) -> None:
+        deadline = time.monotonic() + self._processing_timeout
+        delay = 0.5
+        while True:
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Media {id} has not been processed within {self._processing_timeout}s")
+            time.sleep(delay)
+            delay = min(2 * delay, 5)
+            if self._mastodon_api.media(id).get("url") is not None:
+                return
+
+    def _process(self, media: Media) -> MediaResult:
+        try:
+            file, mime_type, digest = self._download(self._select_variant(media))
+            with file:
+                fingerprint = dhash(file) if self._fingerprint and mime_type.startswith("image/") else None
+                upload_file, mime_type = self._optimize_image(file, mime_type)
+                id, reusable = self._upload(media, upload_file, mime_type, digest)
+                return MediaResult(media, id=id, fingerprint=fingerprint, reusable=reusable)
+        except Exception as e:
+            logger.error(f"Failed to toot media {media.media_url}: {e}")
+            return MediaResult(media, error=e)
+
+    def process(self, media: List[Media]) -> List[MediaResult]:
+        results = list(self._executor.map(self._process, media))
+        if self._cache:
+            self._cache.save()
+        return results
+
+    def release(self, results: List[MediaResult]) -> None:
+        """Make uploads that have not been attached to a status available for reuse."""
+        released = [result for result in results if result.ok and result.reusable]
+        for result in released:
+            digest, key, uploaded = result.reusable
+            self._cache.put_upload(digest, key, result.id, uploaded)
+        if released:
+            self._cache.save()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        if self._process_pool:
+            self._process_pool.shutdown()
+        self._session.close()
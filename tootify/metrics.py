@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class Metrics:
+    """Thread-safe timers and counters, labelled by stage or counter name and an optional source.
+
+    The collected values can be exported as JSON summary or in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timers = defaultdict(lambda: [0, 0.0])
+            self._counters = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage: str, source: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                timer = self._timers[stage, source]
+                timer[0] += 1
+                timer[1] += elapsed
+
+    def count(self, name: str, source: Optional[str] = None, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name, source] += value
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = defaultdict(dict)
+            for (stage, source), (count, seconds) in self._timers.items():
+                stages[stage][source or "all"] = {"count": count, "seconds": seconds}
+            counters = defaultdict(dict)
+            for (name, source), value in self._counters.items():
+                counters[name][source or "all"] = value
+        return {"stages": dict(stages), "counters": dict(counters)}
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self) -> str:
+        def labels(**kwargs) -> str:
+            pairs = ",".join(f'{key}="{value}"' for key, value in kwargs.items() if value is not None)
+            return f"{{{pairs}}}" if pairs else ""
+
+        with self._lock:
+            timers = sorted(self._timers.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+            counters = sorted(self._counters.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+        lines = [
+            "# HELP tootify_stage_seconds_total Time spent per stage.",
+            "# TYPE tootify_stage_seconds_total counter",
+            *(
+                f"tootify_stage_seconds_total{labels(stage=stage, source=source)} {seconds}"
+                for (stage, source), (_, seconds) in timers
+            ),
+            "# HELP tootify_stage_calls_total Number of calls per stage.",
+            "# TYPE tootify_stage_calls_total counter",
+            *(
+                f"tootify_stage_calls_total{labels(stage=stage, source=source)} {count}"
+                for (stage, source), (count, _) in timers
+            ),
+        ]
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE tootify_{name}_total counter")
+            lines.extend(
+                f"tootify_{name}_total{labels(source=source)} {value}"
+                for (counter, source), value in counters
+                if counter == name
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        """Write JSON for ``.json`` files and the Prometheus text format otherwise."""
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_text(self.to_json() if path.suffix == ".json" else self.to_prometheus())
+        tmp_path.replace(path)
+
+
+metrics = Metrics()
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+from tootify.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RateLimited(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    """Token bucket that refills ``capacity`` tokens per ``period`` seconds.
+
+    The bucket learns from the rate limit headers of the instance: it never assumes more tokens than the instance
+    reports as remaining, and it stays empty until the reported reset once the limit has been hit.
+    """
+
+    def __init__(self, capacity: int, period: float) -> None:
+        self._capacity = capacity
+        self._rate = capacity / period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _wait_time(self, now: float) -> float:
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now)
+                if wait == 0:
+                    self._tokens -= 1
+                    return True
+            if now + wait > deadline:
+                return False
+            logger.debug(f"Wait {wait:.1f}s for rate limit")
+            time.sleep(wait)
+
+    def learn(self, remaining: Optional[int], reset: Optional[float]) -> None:
+        if remaining is None:
+            return
+        with self._lock:
+            self._tokens = min(self._tokens, remaining)
+            if remaining <= 0 and reset:
+                self._block_until(reset)
+
+    def block_until(self, reset: float) -> None:
+        with self._lock:
+            self._block_until(reset)
+
+    def _block_until(self, reset: float) -> None:
+        # reset is a unix timestamp, the bucket works with monotonic time
+        self._blocked_until = max(self._blocked_until, time.monotonic() + max(0, reset - time.time()))
+        self._tokens = min(self._tokens, 0)
+
+
+class PostingScheduler:
+    """Throttle media uploads and status posts with separate token buckets.
+
+    Calls wait for a token up to ``max_wait`` seconds and are retried after HTTP 429. If a call cannot be made in
+    time, ``RateLimited`` is raised, so the toot can be deferred to a later run.
+    """
+
+    def __init__(
+        self,
+        mastodon_api,
+        media_limit: int = 30,
+        media_period: float = 30 * 60,
+        status_limit: int = 300,
+        status_period: float = 3 * 60 * 60,
+        max_wait: float = 300,
+        max_retries: int = 3,
+    ) -> None:
+        self._mastodon_api = mastodon_api
+        self._media = TokenBucket(media_limit, media_period)
+        self._status = TokenBucket(status_limit, status_period)
+        self.max_wait = max_wait
+        self._max_retries = max_retries
+
+    def _call(self, bucket: TokenBucket, call: Callable[[], T]) -> T:
+        from mastodon import MastodonRatelimitError
+
+        for attempt in range(self._max_retries + 1):
+            if not bucket.acquire(self.max_wait):
+                raise RateLimited(f"No rate limit budget within {self.max_wait}s")
+            try:
+                result = call()
+            except MastodonRatelimitError as e:
+                logger.warning(f"Rate limit hit (attempt {attempt + 1}): {e}")
+                metrics.count("http_retries")
+                bucket.block_until(getattr(self._mastodon_api, "ratelimit_reset", None) or time.time() + 60)
+                continue
+            bucket.learn(
+                getattr(self._mastodon_api, "ratelimit_remaining", None),
+                getattr(self._mastodon_api, "ratelimit_reset", None),
+            )
+            return result
+        raise RateLimited(f"Rate limit hit {self._max_retries + 1} times")
+
+    def media(self, call: Callable[[], T]) -> T:
+        return self._call(self._media, call)
+
+    def status(self, call: Callable[[], T]) -> T:
+        return self._call(self._status, call)
@@ -1,6 +1,11 @@
 import logging
+import re
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tootify.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -12,10 +17,83 @@ class ReferenceAlreadyExists(ValueError):
     pass
 
 
+def _trie_pattern(words) -> str:
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node) -> str:
+        branches = [re.escape(char) + build(child) for char, child in node.items() if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+
+class Rewriter:
+    """Expand handles and translate hashtags in a single pass.
+
+    All hashtags are compiled into one trie shaped regex, so the cost per post does not grow with the number of
+    mappings. Handles are matched as whole words, so ``@foo`` never touches ``@foobar``.
+    """
+
+    def __init__(
+        self,
+        handle_domain: Optional[str] = None,
+        handle_length: int = 15,
+        familiar_accounts: Dict[str, str] = {},
+        common_hashtags: Dict[str, str] = {},
+    ) -> None:
+        self._handle_domain = handle_domain
+        self._familiar_accounts = dict(familiar_accounts)
+        self._common_hashtags = dict(common_hashtags)
+        patterns = []
+        if handle_domain:
+            patterns.append(f"(?P<handle>(?<![0-9a-zA-Z_])@[0-9a-zA-Z_]{{1,{handle_length}}}(?=[^0-9a-zA-Z_@]|$))")
+        if self._common_hashtags:
+            patterns.append(f"(?P<hashtag>{_trie_pattern(self._common_hashtags)}(?=[^0-9a-zA-Z_@]|$))")
+        self._pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def _replace(self, match: re.Match) -> str:
+        if match.lastgroup == "hashtag":
+            return self._common_hashtags[match["hashtag"]]
+        handle = match["handle"]
+        if handle[1:] in self._familiar_accounts:
+            logger.debug(f"Found {handle} in familiar accounts: {self._familiar_accounts[handle[1:]]}")
+            return f"@{self._familiar_accounts[handle[1:]]}"
+        return f"{handle}@{self._handle_domain}"
+
+    def rewrite(self, text: str) -> str:
+        if self._pattern is None:
+            return text
+        with metrics.timer("rewrite"):
+            return self._pattern.sub(self._replace, text)
+
+
 class Media:
-    def __init__(self, media_url: str, description: Optional[str] = None) -> None:
+    """An attachment. Videos may have several ``variants``, dicts with ``url``, ``content_type`` and ``bit_rate``."""
+
+    def __init__(self, media_url: str, description: Optional[str] = None, variants: List[Dict[str, Any]] = []) -> None:
         self.media_url = media_url
         self.description = description
+        self.variants = variants
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"url": self.media_url, "description": self.description}
+        if self.variants:
+            data["variants"] = self.variants
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Media":
+        return cls(data["url"], data.get("description"), data.get("variants", []))
 
     def __repr__(self) -> str:
         return f"Media({repr(self.media_url)}, {repr(self.description)})"
@@ -29,12 +107,40 @@ class Toot:
         status: str,
         reply_to: Optional[str] = None,
         media: List[Media] = [],
+        attempts: int = 0,
     ) -> None:
         self.source = source
         self.reference = reference
         self.status = status
         self.reply_to = reply_to
         self.media = media
+        # Number of failed attempts to post the toot
+        self.attempts = attempts
+        # Moves the position of the source past this toot, called once the toot and all toots before it have been
+        # posted or deferred
+        self.checkpoint: Optional[Callable[[], None]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "reference": self.reference,
+            "status": self.status,
+            "reply_to": self.reply_to,
+            "media": [media.to_dict() for media in self.media],
+        }
+        if self.attempts:
+            data["attempts"] = self.attempts
+        return data
+
+    @classmethod
+    def from_dict(cls, source: "Source", data: Dict[str, Any]) -> "Toot":
+        return cls(
+            source=source,
+            reference=data["reference"],
+            status=data["status"],
+            reply_to=data.get("reply_to"),
+            media=[Media.from_dict(media) for media in data.get("media", [])],
+            attempts=data.get("attempts", 0),
+        )
 
     def __repr__(self) -> str:
         return f"Toot({repr(self.source)}, {repr(self.reference)}, {repr(self.status)}, {repr(self.in_reply_to_id)}, {repr(self.media)})"
@@ -42,8 +148,8 @@ class Toot:
     @property
     def in_reply_to_id(self):
         if self.reply_to:
-            if self.reply_to in self.source.config["status"]["references"]:
-                return self.source.config["status"]["references"][self.reply_to]
+            if self.reply_to in self.source.references:
+                return self.source.references[self.reply_to]
             else:
                 raise ReferencedPostMissing(f"Did not find referenced post {self.reply_to}")
         else:
@@ -55,15 +161,22 @@ class Toot:
 
     @id.setter
     def id(self, id):
-        if self.reference in self.source.config["status"]["references"]:
+        if self.reference in self.source.references:
             raise ReferenceAlreadyExists(f"Reference {self.reference} already exists.")
         self._id = id
-        self.source.config["status"]["references"][self.reference] = id
+        self.source.references[self.reference] = id
 
 
 class Source(ABC):
-    def __init__(self, config: Dict[str, Any]) -> None:
+    name: Optional[str] = None
+    handle_domain: Optional[str] = None
+    handle_length: int = 15
+
+    def __init__(self, config: Dict[str, Any], status_path: Optional[Path] = None) -> None:
         self._config = config
+        self._status_path = status_path
+        self._rewriter = None
+        self._references = None
         if not "status" in self.config:
             self.config["status"] = {"references": {}}
         self._new_posts = []
@@ -72,12 +185,46 @@ class Source(ABC):
     def config(self):
         return self._config
 
+    @property
+    def references(self) -> MutableMapping:
+        if self._references is None:
+            return self.config["status"].setdefault("references", {})
+        return self._references
+
+    @references.setter
+    def references(self, references: MutableMapping) -> None:
+        self._references = references
+
+    @property
+    def rewriter(self) -> Rewriter:
+        if self._rewriter is None:
+            self._rewriter = Rewriter(
+                handle_domain=self.handle_domain,
+                handle_length=self.handle_length,
+                familiar_accounts=self.config.get("familiar_accounts", {}),
+                common_hashtags=self.config.get("common_hashtags", {}),
+            )
+        return self._rewriter
+
+    def _checkpoint(self, **position) -> Callable[[], None]:
+        """Return a ``Toot.checkpoint`` that updates the status of the source with ``position``."""
+        return lambda: self.config["status"].update(position)
+
+    def cache_path(self, name: str) -> Optional[Path]:
+        if self._status_path is None:
+            return None
+        return self._status_path.with_name(f"{self._status_path.stem}.{name}")
+
     def __iter__(self):
-        self._new_posts = iter(self.get_new_posts())
+        with metrics.timer("fetch", self.name):
+            self._new_posts = iter(self.get_new_posts())
         return self
 
     def __next__(self):
-        return next(self._new_posts)
+        with metrics.timer("fetch", self.name):
+            toot = next(self._new_posts)
+        metrics.count("posts_seen", self.name)
+        return toot
 
     @abstractmethod
     def connect(self):
@@ -86,3 +233,58 @@ class Source(ABC):
     @abstractmethod
     def get_new_posts(self) -> List[Toot]:
         pass
+
+    def get_history(self, archive: Optional[Path] = None) -> Iterator[Toot]:
+        """Yield the posts before the current position of the source, oldest first.
+
+        The posts are read from the API or, if given, from an exported ``archive``.
+        """
+        raise NotImplementedError(f"{self.name} does not support backfilling")
+
+    def _backfill(self, posts: Iterable[Tuple[Any, Any]], tootify: Callable[[Any], Optional[Toot]]) -> Iterator[Toot]:
+        """Yield the toots of ``(position, post)`` pairs oldest first and checkpoint the position in the status.
+
+        Posts before the checkpoint are skipped. Posts at the checkpoint and posts that have been tooted before are
+        recognized by their reference, so an interrupted backfill resumes exactly where it stopped. The position only
+        moves on once the consumer calls ``Toot.checkpoint``.
+        """
+        status = self.config["status"]
+        position = status.get("backfill", {}).get("position")
+        for key, post in sorted(posts, key=lambda item: item[0]):
+            if position is not None and key < position:
+                continue
+            toot = tootify(post)
+            if toot and toot.reference not in self.references:
+                metrics.count("posts_seen", self.name)
+                toot.checkpoint = self._checkpoint(backfill={"position": key})
+                yield toot
+        # Backfills post one toot at a time, so the last toot has been handled once the next one is requested
+        status.pop("backfill", None)
+
+
+class AsyncSource:
+    """Adapter to use a synchronous ``Source`` from asyncio. Blocking calls run in a worker thread."""
+
+    def __init__(self, source: Source) -> None:
+        self._source = source
+
+    @property
+    def source(self) -> Source:
+        return self._source
+
+    async def connect(self):
+        import asyncio
+
+        await asyncio.to_thread(self._source.connect)
+
+    async def get_new_posts(self) -> AsyncIterator[Toot]:
+        """Yield the new posts one at a time, so the source only moves on as far as its posts have been consumed."""
+        import asyncio
+
+        posts = await asyncio.to_thread(iter, self._source)
+        end = object()
+        while True:
+            toot = await asyncio.to_thread(next, posts, end)
+            if toot is end:
+                return
+            yield toot
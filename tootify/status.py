@@ -0,0 +1,117 @@
+import logging
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteReferences(MutableMapping):
+    """Mapping of references to toot IDs for one source, backed by a ``SQLiteStore``.
+
+    Every assignment is committed immediately, so a crash does not lose any mappings.
+    """
+
+    def __init__(self, store: "SQLiteStore", source: str) -> None:
+        self._store = store
+        self._source = source
+
+    def __getitem__(self, reference: Any) -> Any:
+        row = self._store.execute(
+            "SELECT id FROM refs WHERE source = ? AND reference = ?", (self._source, str(reference))
+        ).fetchone()
+        if row is None:
+            raise KeyError(reference)
+        return row[0]
+
+    def __setitem__(self, reference: Any, id: Any) -> None:
+        self._store.execute(
+            "INSERT OR REPLACE INTO refs (source, reference, id) VALUES (?, ?, ?)",
+            (self._source, str(reference), str(id)),
+        )
+
+    def __delitem__(self, reference: Any) -> None:
+        deleted = self._store.execute(
+            "DELETE FROM refs WHERE source = ? AND reference = ?", (self._source, str(reference))
+        ).rowcount
+        if deleted == 0:
+            raise KeyError(reference)
+
+    def __contains__(self, reference: Any) -> bool:
+        return (
+            self._store.execute(
+                "SELECT 1 FROM refs WHERE source = ? AND reference = ?", (self._source, str(reference))
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self._store.execute("SELECT reference FROM refs WHERE source = ?", (self._source,)).fetchall()
+        return iter(row[0] for row in rows)
+
+    def __len__(self) -> int:
+        return self._store.execute("SELECT COUNT(*) FROM refs WHERE source = ?", (self._source,)).fetchone()[0]
+
+
+class SQLiteFingerprints:
+    """Fingerprints for the ``DuplicateIndex``, backed by a ``SQLiteStore``."""
+
+    def __init__(self, store: "SQLiteStore") -> None:
+        self._store = store
+
+    def load(self, since: float) -> List[Dict[str, Any]]:
+        self._store.execute("DELETE FROM fingerprints WHERE time < ?", (since,))
+        rows = self._store.execute("SELECT time, text, media, id, source FROM fingerprints").fetchall()
+        return [
+            {"time": time, "text": text, "media": media.split(), "id": id, "source": source}
+            for time, text, media, id, source in rows
+        ]
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        self._store.execute(
+            "INSERT INTO fingerprints (time, text, media, id, source) VALUES (?, ?, ?, ?, ?)",
+            (entry["time"], entry["text"], " ".join(entry["media"]), entry["id"], entry["source"]),
+        )
+
+
+class SQLiteStore:
+    """Store the references of all sources in an indexed SQLite database instead of the YAML status file."""
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS refs (source TEXT, reference TEXT, id TEXT, PRIMARY KEY (source, reference))"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints (time REAL, text TEXT, media TEXT, id TEXT, source TEXT)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_time ON fingerprints (time)")
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connection.execute(sql, parameters)
+
+    def references(self, source: str) -> SQLiteReferences:
+        return SQLiteReferences(self, source)
+
+    def fingerprints(self) -> SQLiteFingerprints:
+        return SQLiteFingerprints(self)
+
+    def migrate(self, source: str, status: Dict[str, Any]) -> None:
+        references = status.pop("references", None) or {}
+        if references:
+            logger.info(f"Migrate {len(references)} references of {source} to {self._path}")
+            with self._lock, self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO refs (source, reference, id) VALUES (?, ?, ?)",
+                    ((source, str(reference), str(id)) for reference, id in references.items()),
+                )
+
+    def close(self) -> None:
+        self._connection.close()
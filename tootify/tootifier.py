@@ -1,48 +1,138 @@
+import hashlib
+import heapq
 import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
-import requests
 import yaml
-from mastodon import Mastodon
 
-from tootify.source import ReferencedPostMissing, ReferenceAlreadyExists
+from tootify.cache import MediaCache
+from tootify.metrics import metrics
+from tootify.ratelimit import PostingScheduler, RateLimited
+from tootify.source import AsyncSource, ReferencedPostMissing, ReferenceAlreadyExists, Toot
 
 logger = logging.getLogger(__name__)
 
+# Mastodon.py, requests and asyncio are imported where they are used, so runs without new posts start quickly.
+# The C implementations of the YAML loader and dumper are used if available.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.dumper.SafeDumper)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether posting may succeed later, after rate limits, network errors and server errors (5xx)."""
+    from mastodon import MastodonNetworkError, MastodonServerError
+
+    return isinstance(error, (RateLimited, MastodonNetworkError, MastodonServerError))
+
+
+def _store_path(status: Dict[str, Any], status_path: Path) -> Path:
+    return status_path.parent / status.get("store", {}).get("path", f"{status_path.stem}.db")
+
+
+def sidecar_files(config: Path) -> List[Path]:
+    """Files besides the config file that keep the state of a config: the SQLite store and the URL cache.
+
+    Runners that work on a copy of the config file have to copy these files as well.
+    """
+    with config.open("r") as f:
+        status = yaml.load(f, YamlLoader) or {}
+    files = []
+    if status.get("store", {}).get("backend", "yaml") == "sqlite":
+        files.append(_store_path(status, config))
+    if "twitter" in status:
+        files.append(config.with_name(f"{config.stem}.urls.json"))
+    return files
+
 
 class Tootifier:
     def __init__(self, config: Path) -> None:
         self._status_path = config
         self._sources = {}
+        self._mastodon_api = None
+        self._media_pipeline = None
+        self._scheduler = None
+        self._connect_lock = threading.Lock()
+        # Posting threads write references, pending toots and positions into the status while it may be written
+        self._status_lock = threading.Lock()
+        self._deferring = False
         self._read_status()
 
     def _read_status(self) -> None:
-        self._status = yaml.load(self._status_path.open("r"), yaml.SafeLoader) or {}
+        with self._status_path.open("r") as f:
+            self._status = yaml.load(f, YamlLoader) or {}
         if "instagram" in self._status:
             from tootify.instagram import IGSource
 
-            self._sources["instagram"] = IGSource(self._status["instagram"])
+            self._sources["instagram"] = IGSource(self._status["instagram"], self._status_path)
         if "twitter" in self._status:
             from tootify.twitter import TwitterSource
 
-            self._sources["twitter"] = TwitterSource(self._status["twitter"])
+            self._sources["twitter"] = TwitterSource(self._status["twitter"], self._status_path)
         if "feed" in self._status:
             from tootify.feed import FeedSource
 
-            self._sources["feed"] = FeedSource(self._status["feed"])
+            self._sources["feed"] = FeedSource(self._status["feed"], self._status_path)
         if "mastodon" not in self._status:
             logger.warning("No mastodon credentials found. Run with --login.")
+        self._open_store()
 
-    def _write_status(self, dry_run: bool = False) -> None:
-        for source in self._sources:
-            self._status[source] = self._sources[source].config
-        if not dry_run:
-            yaml.dump(self._status, self._status_path.open("w"), yaml.dumper.SafeDumper)
+    def _open_store(self) -> None:
+        store_config = self._status.get("store", {})
+        backend = store_config.get("backend", "yaml")
+        if backend == "yaml":
+            self._store = None
+        elif backend == "sqlite":
+            from tootify.status import SQLiteStore
+
+            self._store = SQLiteStore(_store_path(self._status, self._status_path))
+            for name, source in self._sources.items():
+                self._store.migrate(name, source.config["status"])
+                source.references = self._store.references(name)
         else:
-            logger.info("Dry run: Skip updating config.")
-            logger.debug(self._status)
+            raise ValueError(f"Unknown store backend {backend}")
+        self._duplicates = None
+        if "dedup" in self._status:
+            from tootify.dedup import DuplicateIndex, YAMLFingerprints
+
+            dedup_config = self._status["dedup"] or {}
+            if self._store:
+                fingerprints = self._store.fingerprints()
+            else:
+                fingerprints = YAMLFingerprints(self._status.setdefault("fingerprints", []))
+            self._duplicates = DuplicateIndex(
+                fingerprints,
+                window=dedup_config.get("window", 7 * 24 * 60 * 60),
+                max_distance=dedup_config.get("max_distance", 3),
+                media_distance=dedup_config.get("media_distance", 6),
+                min_words=dedup_config.get("min_words", 4),
+            )
+
+    def _write_status(self, dry_run: bool = False) -> None:
+        with metrics.timer("write_status"):
+            self._write_status_file(dry_run)
+
+    def _write_status_file(self, dry_run: bool = False) -> None:
+        with self._status_lock:
+            for source in self._sources:
+                self._status[source] = self._sources[source].config
+            if not dry_run:
+                # Write to a temporary file first, so a crash cannot leave a truncated status behind
+                tmp_path = self._status_path.with_name(f"{self._status_path.name}.tmp")
+                with tmp_path.open("w") as f:
+                    yaml.dump(self._status, f, YamlDumper)
+                tmp_path.replace(self._status_path)
+            else:
+                logger.info("Dry run: Skip updating config.")
+                logger.debug(self._status)
 
     def login(self, instance: str, username: str, password: str, /, dry_run: bool = False):
+        from mastodon import Mastodon
+
         base_url = f"https://{instance}"
         client_id, client_secret = Mastodon.create_app("tootifier", api_base_url=base_url)
         logger.debug(f'Created mastodon app "tootifier".')
@@ -66,61 +156,473 @@ class Tootifier:
             logger.critical(f"Failed to login at {base_url}: {r.get('error')}")
         self._write_status(dry_run)
 
-    def connect(self):
+    def _media_limits(self):
+        try:
+            config = self._mastodon_api.instance()["configuration"]["media_attachments"]
+            return {key: int(config[key]) for key in ("image_size_limit", "image_matrix_limit", "video_size_limit")}
+        except Exception as e:
+            logger.warning(f"Could not read the media limits of the instance: {e}")
+            return {}
+
+    def _verify_credentials(self):
+        mastodon_config = self._status["mastodon"]
+        token = hashlib.sha256(mastodon_config["access_token"].encode()).hexdigest()[:16]
+        verified = mastodon_config.get("verified")
+        if verified and verified.get("token") == token and verified["expires_at"] > datetime.now():
+            logger.debug(f"Credentials verified until {verified['expires_at']}")
+            return verified
+        check = self._mastodon_api.account_verify_credentials()
+        if check.get("error"):
+            logger.error(check.get("error connecting to Mastodon"))
+            return None
+        verified = {
+            "token": token,
+            "id": str(check["id"]),
+            "username": str(check["username"]),
+            "media_limits": self._media_limits(),
+            "expires_at": datetime.now() + timedelta(seconds=mastodon_config.get("verify_ttl", 24 * 60 * 60)),
+        }
+        with self._status_lock:
+            mastodon_config["verified"] = verified
+        return verified
+
+    def _connect_mastodon(self):
+        from mastodon import Mastodon
+
+        from tootify.media import MediaPipeline
+
         logger.debug("connect to Mastodon")
         self._mastodon_api = Mastodon(
             client_id=self._status["mastodon"].get("client_id", None),
             client_secret=self._status["mastodon"].get("client_secret", None),
             access_token=self._status["mastodon"]["access_token"],
             api_base_url=f"https://{self._status['mastodon']['instance']}",
+            ratelimit_method="throw",
+        )
+        self._scheduler = PostingScheduler(self._mastodon_api, **self._status.get("ratelimit", {}))
+        verified = self._verify_credentials()
+        account = None
+        if verified:
+            account = f"{verified['id']}@{self._status['mastodon']['instance']}"
+            logger.info(f"connected on @{verified['username']}@{self._status['mastodon']['instance']}")
+        media_config = self._status.get("media", {})
+        media_cache = None
+        if media_config.get("cache"):
+            media_cache = MediaCache(
+                self._status_path.parent / media_config["cache"],
+                max_size=media_config.get("cache_size", 256) * 2**20,
+            )
+        self._media_pipeline = MediaPipeline(
+            self._mastodon_api,
+            max_workers=media_config.get("workers", 4),
+            timeout=media_config.get("timeout", 30),
+            cache=media_cache,
+            namespace=account,
+            reuse_uploads=media_config.get("reuse_uploads", 0),
+            scheduler=self._scheduler,
+            limits=(verified or {}).get("media_limits", {}),
+            optimize=media_config.get("optimize", True),
+            optimize_workers=media_config.get("optimize_workers", 2),
+            spool_size=media_config.get("spool_size", 1) * 2**20,
+            max_download_size=media_config.get("max_download_size", 100) * 2**20,
+            fingerprint=self._duplicates is not None,
+            processing_timeout=media_config.get("processing_timeout", 300),
         )
-        check = self._mastodon_api.account_verify_credentials()
-        if check.get("error"):
-            logger.error(check.get("error connecting to Mastodon"))
-        else:
-            username = str(check["username"])
-            logger.info(f"connected on @{username}@{self._status['mastodon']['instance']}")
 
+    def _ensure_mastodon(self):
+        # Toots are posted from several threads, but all of them have to share one client and its rate limits.
+        # The media pipeline is created last, so it marks a completed connection.
+        if self._media_pipeline is None:
+            with self._connect_lock:
+                if self._media_pipeline is None:
+                    self._connect_mastodon()
+
+    def connect(self, probe: bool = False):
+        """Connect to Mastodon and all sources.
+
+        With ``probe``, only the sources are connected. Mastodon is connected once there is something to post.
+        """
+        if not probe:
+            self._ensure_mastodon()
         for source in self._sources:
-            logger.debug(f"connect to {source}")
-            self._sources[source].connect()
+            self.connect_source(source)
+
+    def connect_source(self, name: str):
+        """Connect a single source, or connect it again, e.g. to refresh its access token."""
+        logger.debug(f"connect to {name}")
+        self._sources[name].connect()
 
     def _toot_media(self, media):
-        result = []
-        for media in media:
-            response = requests.get(media.media_url)
-            if response.ok:
-                result.append(
-                    self._mastodon_api.media_post(
-                        response.content, mime_type=response.headers["content-type"], description=media.description
+        results = self._media_pipeline.process(media)
+        failed = [result for result in results if not result.ok]
+        if any(isinstance(result.error, RateLimited) for result in failed):
+            self._media_pipeline.release(results)
+            raise RateLimited("Media upload throttled")
+        if failed:
+            logger.error(f"{len(failed)} of {len(results)} attachments failed: {failed}")
+        return results
+
+    def _link_duplicate(self, toot, duplicate) -> bool:
+        if duplicate is None:
+            return False
+        source = toot.source.name
+        logger.info(f"Skip {toot.reference} from {source}, it duplicates {duplicate['id']} from {duplicate['source']}")
+        metrics.count("posts_duplicate", source)
+        if (self._status["dedup"] or {}).get("action", "link") == "link":
+            # Replies to the duplicate are threaded below the toot that has already been posted
+            with self._status_lock:
+                toot.id = duplicate["id"]
+        return True
+
+    def _source_name(self, source) -> str:
+        return next(name for name, candidate in self._sources.items() if candidate is source)
+
+    def _parent_pending(self, toot) -> bool:
+        if toot.reply_to is None or toot.reply_to in toot.source.references:
+            return False
+        name = self._source_name(toot.source)
+        return any(
+            entry["source"] == name and str(entry["reference"]) == str(toot.reply_to)
+            for entry in self._status.get("pending", [])
+        )
+
+    def _defer(self, toot, failed: bool = False, hold_following: bool = False):
+        name = self._source_name(toot.source)
+        if failed:
+            toot.attempts += 1
+            max_attempts = self._status.get("posting", {}).get("max_attempts", 5)
+            if toot.attempts >= max_attempts:
+                logger.error(f"Drop {toot.reference} from {name} after {toot.attempts} failed attempts")
+                return
+        if hold_following:
+            # Once a toot has been rate limited, defer all following toots as well to keep their order
+            self._deferring = True
+        logger.warning(f"Defer {toot.reference} from {name} to the next run")
+        metrics.count("posts_deferred", name)
+        with self._status_lock:
+            self._status.setdefault("pending", []).append({"source": name, **toot.to_dict()})
+
+    def _resume_pending(self, skip: bool = False):
+        pending = self._status.pop("pending", None) or []
+        self._deferring = False
+        if pending:
+            logger.info(f"Resume {len(pending)} deferred toots")
+        toots = []
+        for data in pending:
+            if data["source"] in self._sources:
+                toots.append(Toot.from_dict(self._sources[data["source"]], data))
+            else:
+                logger.error(f"Drop deferred toot {data['reference']} of unknown source {data['source']}")
+        self._post_all(toots, skip)
+
+    def _post(self, toot, skip: bool = False):
+        source = toot.source.name
+        if skip:
+            logger.info(f"Skip tooting {toot.reference}")
+            metrics.count("posts_skipped", source)
+            return
+        if toot.reference in toot.source.references:
+            # The source returns a toot again if its position was not saved after the toot had been posted
+            logger.info(f"Skip {toot.reference}, it has been tooted already")
+            return
+        if self._deferring:
+            self._defer(toot)
+            return
+        if self._parent_pending(toot):
+            # The reply is posted below its parent once the parent has been posted from the pending toots
+            logger.info(f"Defer {toot.reference}, its parent {toot.reply_to} is pending")
+            self._defer(toot)
+            return
+        reservation = None
+        media_results = []
+        # Once the status has been posted, the media may have been attached even if the response got lost
+        posting = False
+        try:
+            text_hash = None
+            if self._duplicates:
+                text_hash = self._duplicates.text_hash(toot.status)
+                if self._link_duplicate(toot, self._duplicates.find(text_hash, [], source)):
+                    return
+            self._ensure_mastodon()
+            in_reply_to_id = toot.in_reply_to_id
+            logger.debug(f"Toot media for {toot.reference}")
+            media_results = self._toot_media(toot.media)
+            media_ids = [result.id for result in media_results if result.ok]
+            media_hashes = [result.fingerprint for result in media_results]
+            if self._duplicates:
+                # Another worker may be posting the same post from another source right now
+                duplicate, reservation = self._duplicates.reserve(text_hash, media_hashes, source)
+                if self._link_duplicate(toot, duplicate):
+                    return
+            logger.debug(f"Toot {toot.reference}")
+            # If the response of an earlier attempt got lost, the instance returns the status it has already created
+            idempotency_key = hashlib.sha256(f"{source}:{toot.reference}".encode()).hexdigest()
+            posting = True
+            with metrics.timer("status_post", source):
+                status = self._scheduler.status(
+                    lambda: self._mastodon_api.status_post(
+                        toot.status,
+                        in_reply_to_id=in_reply_to_id,
+                        media_ids=media_ids,
+                        idempotency_key=idempotency_key,
                     )
                 )
-        return result
+            with self._status_lock:
+                # Mastodon.py 2 wraps IDs in its own types, which cannot be stored in the YAML status
+                toot.id = str(status["id"])
+                if reservation:
+                    self._duplicates.confirm(reservation, toot.id)
+            metrics.count("posts_posted", source)
+        except RateLimited as e:
+            # Rate limited calls have not been made or have been rejected
+            posting = False
+            logger.error(f"Rate limited: {e}")
+            self._defer(toot, hold_following=True)
+        except ReferencedPostMissing:
+            logger.error("Skip toot, as referenced post could not be found.")
+            metrics.count("posts_failed", source)
+        except ReferenceAlreadyExists:
+            logger.fatal("Reference already exists. Possible duplicate!")
+            metrics.count("posts_failed", source)
+        except Exception:
+            metrics.count("posts_failed", source)
+            raise
+        finally:
+            if reservation and reservation["id"] is None:
+                self._duplicates.release(reservation)
+            if media_results and not posting:
+                self._media_pipeline.release(media_results)
+
+    def _post_or_defer(self, toot, skip: bool = False):
+        try:
+            self._post(toot, skip)
+        except Exception as e:
+            # The source has already moved on, so the toot can only be retried from the pending toots
+            if _is_transient(e):
+                logger.error(f"Failed to toot {toot.reference}: {e}")
+                self._defer(toot, failed=True)
+            else:
+                logger.exception(f"Drop {toot.reference}, it has been rejected: {e}")
+
+    def _post_all(self, toots: Iterable[Toot], skip: bool = False, on_posted: Optional[Callable] = None) -> int:
+        """Post toots in the order of their replies and return the number of toots.
+
+        Replies wait until their parent has been posted. A reply fetched before its parent is held until the parent
+        is fetched, or until the source is exhausted or the lookahead is full. Independent toots are posted
+        concurrently by up to ``posting.workers`` threads; with the default of one worker, toots are posted in the
+        order of the source. The checkpoints of the toots are called in the order of the source, once all earlier toots
+        have been posted or deferred as well.
+        """
+        posting_config = self._status.get("posting", {})
+        workers = posting_config.get("workers", 1)
+        lookahead = posting_config.get("lookahead", 8) * workers
+        toots = iter(toots)
+        # Toots that have been fetched but not posted yet, with the replies waiting for them
+        unfinished = {}
+        # Replies that have been fetched before their parent, by the parent
+        orphans = {}
+        # Toots that can be posted, by the order of the source
+        ready = []
+        running = {}
+        # Handled toots that wait for earlier toots before their checkpoint is called, by the order of the source
+        handled = {}
+        checkpointed = 0
+        count = 0
+        errors = []
+        exhausted = False
+        key = lambda toot, reference: (toot.source.name, str(reference))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tootify-post") as executor:
+            while True:
+                while len(running) < workers:
+                    if ready:
+                        seq, toot = heapq.heappop(ready)
+                        running[executor.submit(self._post_or_defer, toot, skip)] = seq, toot
+                        continue
+                    # Fetch ahead while workers are idle, but do not run far ahead of posting
+                    if exhausted or len(unfinished) >= lookahead:
+                        break
+                    try:
+                        toot = next(toots)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    except Exception as e:
+                        errors.append(e)
+                        exhausted = True
+                        break
+                    count += 1
+                    parent = key(toot, toot.reply_to) if toot.reply_to is not None else None
+                    if parent in unfinished:
+                        logger.debug(f"{toot.reference} waits for {toot.reply_to}")
+                        unfinished[parent].append((count, toot))
+                    elif parent is not None and toot.reply_to not in toot.source.references:
+                        logger.debug(f"{toot.reference} waits for {toot.reply_to} to be fetched")
+                        orphans.setdefault(parent, []).append((count, toot))
+                    else:
+                        heapq.heappush(ready, (count, toot))
+                    reference = key(toot, toot.reference)
+                    unfinished.setdefault(reference, []).extend(orphans.pop(reference, []))
+                if not running and orphans:
+                    # Nothing else can be fetched, so stop waiting for the parent of the oldest reply
+                    parent = min(orphans, key=lambda parent: orphans[parent][0][0])
+                    logger.debug(f"{parent[1]} has not been fetched")
+                    for item in orphans.pop(parent):
+                        heapq.heappush(ready, item)
+                    continue
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                finished = []
+                for future in done:
+                    seq, toot = running.pop(future)
+                    finished.append(toot)
+                    if future.exception():
+                        errors.append(future.exception())
+                    else:
+                        handled[seq] = toot
+                    for item in unfinished.pop(key(toot, toot.reference), []):
+                        heapq.heappush(ready, item)
+                # The source only moves on past toots that have been posted or deferred, even if later ones were faster
+                while checkpointed + 1 in handled:
+                    checkpointed += 1
+                    toot = handled.pop(checkpointed)
+                    if toot.checkpoint:
+                        with self._status_lock:
+                            toot.checkpoint()
+                if on_posted:
+                    for toot in finished:
+                        on_posted(toot)
+        if errors:
+            raise errors[0]
+        return count
 
     def toot(self, dry_run: bool = False, skip: bool = False):
         skip = skip or dry_run
 
         try:
+            self._resume_pending(skip)
             for source in self._sources.values():
-                for toot in source:
-                    if skip:
-                        logger.info(f"Skip tooting {toot.reference}")
-                    else:
-                        try:
-                            in_reply_to_id = toot.in_reply_to_id
-                            logger.debug(f"Toot media for {toot.reference}")
-                            media_ids = self._toot_media(toot.media)
-                            logger.debug(f"Toot {toot.reference}")
-                            status = self._mastodon_api.status_post(
-                                toot.status,
-                                in_reply_to_id=in_reply_to_id,
-                                media_ids=media_ids,
-                            )
-                            toot.id = status["id"]
-                        except ReferencedPostMissing:
-                            logger.error("Skip toot, as referenced post could not be found.")
-                        except ReferenceAlreadyExists:
-                            logger.fatal("Reference already exists. Possible duplicate!")
+                self._post_all(source, skip)
+        finally:
+            # Update config in any case, not to toot anything multiple times
+            self._write_status(dry_run)
+
+    def toot_source(self, name: str, dry_run: bool = False, skip: bool = False) -> int:
+        """Toot the new posts of a single source and persist the status after every toot.
+
+        Returns the number of new posts.
+        """
+        skip = skip or dry_run
+        count = 0
+        try:
+            self._resume_pending(skip)
+            count = self._post_all(self._sources[name], skip, on_posted=lambda toot: self._write_status(dry_run))
+        finally:
+            self._write_status(dry_run)
+        return count
+
+    def backfill(self, name: str, archive: Optional[Path] = None, dry_run: bool = False, skip: bool = False) -> int:
+        """Toot the history of a source oldest first, from its API or an exported ``archive``.
+
+        The position is checkpointed in the status after every toot, so an interrupted backfill can simply be started
+        again. Returns the number of toots.
+        """
+        if name not in self._sources:
+            raise ValueError(f"Unknown source {name}")
+        source = self._sources[name]
+        skip = skip or dry_run
+        backfill_config = self._status.get("backfill", {})
+        if archive is None:
+            source.connect()
+        if not skip:
+            self._ensure_mastodon()
+        if self._scheduler:
+            # Wait for the rate limits instead of deferring the rest of the history
+            self._scheduler.max_wait = backfill_config.get("max_wait", 24 * 60 * 60)
+        report_interval = backfill_config.get("report_interval", 10)
+        count = 0
+        start = last_report = time.monotonic()
+        try:
+            self._resume_pending(skip)
+            for toot in source.get_history(archive):
+                # Toots rejected by the instance are dropped, so the checkpoint moves past them
+                self._post_or_defer(toot, skip)
+                toot.checkpoint()
+                if self._deferring:
+                    logger.warning(f"Stop backfilling {name}, the rate limit did not recover in time")
+                    break
+                if toot.reference in source.references:
+                    count += 1
+                    metrics.count("posts_backfilled", name)
+                self._write_status(dry_run)
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    logger.info(f"Backfilled {count} posts of {name} ({count / (now - start):.2f} posts/s)")
+                    last_report = now
+        finally:
+            self._write_status(dry_run)
+        elapsed = time.monotonic() - start
+        logger.info(f"Backfilled {count} posts of {name} in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.2f} posts/s)")
+        return count
+
+    def close(self) -> None:
+        """Close the media pipeline and the status store, so all state has been written to the files."""
+        if self._media_pipeline:
+            self._media_pipeline.close()
+        if self._store:
+            self._store.close()
+
+    @property
+    def sources(self):
+        return list(self._sources)
+
+    @property
+    def config(self):
+        return self._status
+
+    async def connect_async(self, probe: bool = False):
+        import asyncio
+
+        await asyncio.gather(
+            *([] if probe else [asyncio.to_thread(self._ensure_mastodon)]),
+            *(AsyncSource(source).connect() for source in self._sources.values()),
+        )
+
+    async def _toot_source_async(self, name: str, source: AsyncSource, skip: bool):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        posts = source.get_new_posts()
+
+        async def next_post():
+            return await posts.__anext__()
+
+        def toots():
+            # Posting runs in a worker thread and fetches the next post only when it is ready to post it
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(next_post(), loop).result()
+                except StopAsyncIteration:
+                    return
+
+        count = await asyncio.to_thread(self._post_all, toots(), skip)
+        logger.debug(f"Fetched {count} new posts from {name}")
+
+    async def toot_async(self, dry_run: bool = False, skip: bool = False):
+        """Fetch all sources concurrently. The toots of each source are posted in order."""
+        import asyncio
+
+        skip = skip or dry_run
+
+        try:
+            await asyncio.to_thread(self._resume_pending, skip)
+            results = await asyncio.gather(
+                *(self._toot_source_async(name, AsyncSource(source), skip) for name, source in self._sources.items()),
+                return_exceptions=True,
+            )
         finally:
             # Update config in any case, not to toot anything multiple times
             self._write_status(dry_run)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
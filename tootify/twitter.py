@@ -1,58 +1,40 @@
+import html
+import json
 import logging
 import re
-import urllib
 from collections import defaultdict
-from typing import Any, TextIO
+from pathlib import Path
+from typing import Any, Optional, TextIO
 
-from tweepy import Client
+from tootify.cache import TTLCache
+from tootify.source import Media, Source, Toot
 
 logger = logging.getLogger(__name__)
 
-
-from tootify.source import Media, Source, Toot
+SHORT_URL_PATTERN = re.compile("https://t.co/[0-9a-zA-Z]+")
 
 
 class TwitterSource(Source):
+    name = "twitter"
+    handle_domain = "twitter.com"
+    handle_length = 15
+    _url_resolver = None
+
     def _expand_urls(self, text: str):
         # Find twitter short urls
-        urls = re.findall("https://t.co/[0-9a-zA-Z]+", text)
-        for url in urls:
-            try:
-                res = urllib.request.urlopen(url)
-                expanded_url = res.geturl()
-                text = text.replace(url, expanded_url)
-            except:
-                logger.error(f"Failed to expand {url}.")
-        return text
+        expanded_urls = self._url_resolver.resolve(SHORT_URL_PATTERN.findall(text))
+        return SHORT_URL_PATTERN.sub(lambda match: expanded_urls.get(match[0], match[0]), text)
 
     def _strip_self_referencing_urls(self, text: str, tweet_id):
         url = f"https://twitter.com/{self.config['username']}/status/{tweet_id}/"
         logger.debug(f"Strip {url}([a-zA-Z0-9]+/)+")
         return re.sub(f"{url}([a-zA-Z0-9]+/)+[a-zA-Z0-9]*", "", text)
 
-    def _expand_handles(self, text: str):
-        # Find twitter short urls
-        handles = re.findall("(?<=[^0-9a-zA-Z_])@[0-9a-zA-Z_]{1,15}(?=[^0-9a-zA-Z_@]|$)", text)
-        familiar_accounts = self.config.get("familiar_accounts", {})
-        for handle in handles:
-            if handle[1:] in familiar_accounts:
-                logger.debug(f"Found {handle} in familiar accounts: {familiar_accounts[handle[1:]]}")
-                text = text.replace(handle, f"@{familiar_accounts[handle[1:]]}")
-            else:
-                text = text.replace(handle, f"{handle}@twitter.com")
-        return text
-
-    def _translate_hashtags(self, text: str) -> str:
-        result = text
-        for hashtag, replacement in self.config.get("common_hashtags", {}).items():
-            result = re.sub(f"{re.escape(hashtag)}(?=[^0-9a-zA-Z_@]|$)", replacement, result)
-        return result
-
-    def tootify(self, tweet, included_media):
+    def tootify(self, tweet, media_index):
         media = []
         if tweet.attachments:
             for media_key in tweet.attachments.get("media_keys", []):
-                item = next((item for item in included_media if item.media_key == media_key), None)
+                item = media_index.get(media_key)
                 if item:
                     logger.debug(f"Found media {item.url}")
                     media.append(item)
@@ -65,32 +47,150 @@ class TwitterSource(Source):
             replied_to = ([ref.id for ref in tweet.referenced_tweets or [] if ref.type == "replied_to"] or [None])[0]
 
         logger.debug(f"Clean text: {tweet.text}")
-        tweet_text = self._translate_hashtags(
-            self._strip_self_referencing_urls(self._expand_urls(self._expand_handles(tweet.text)), tweet_id=tweet.id)
+        tweet_text = self._strip_self_referencing_urls(
+            self._expand_urls(self.rewriter.rewrite(tweet.text)), tweet_id=tweet.id
         )
         return Toot(
             source=self,
             reference=tweet.id,
             status=tweet_text,
             reply_to=replied_to,
-            media=[Media(media_item.url, media_item.alt_text) for media_item in media],
+            media=[self._media(media_item) for media_item in media],
         )
 
+    def _media(self, item) -> Media:
+        # Videos and GIFs have no url, only variants in different formats and bit rates
+        variants = [
+            {"url": variant["url"], "content_type": variant.get("content_type"), "bit_rate": variant.get("bit_rate", 0)}
+            for variant in item.variants or []
+            if variant.get("content_type") == "video/mp4"
+        ]
+        variants.sort(key=lambda variant: variant["bit_rate"], reverse=True)
+        url = item.url or (variants[0]["url"] if variants else None)
+        return Media(url, item.alt_text, variants)
+
     def connect(self):
+        from tweepy import Client
+
+        from tootify.urls import UrlResolver
+
         self._twitter_client = Client(bearer_token=self.config["bearer_token"])
         self._twitter_user_id = self._twitter_client.get_user(username=self.config["username"]).data.id
+        # The resolver is kept when the source is connected again
+        if self._url_resolver is None:
+            self._url_resolver = UrlResolver(
+                TTLCache(self.cache_path("urls.json"), ttl=self.config.get("url_cache_ttl", 30 * 24 * 60 * 60)),
+                max_workers=self.config.get("url_workers", 8),
+                timeout=self.config.get("url_timeout", 10),
+            )
+
+    def _get_pages(self, since_id, all_pages: bool = False):
+        pagination_token = None
+        while True:
+            page = self._twitter_client.get_users_tweets(
+                id=self._twitter_user_id,
+                exclude=["retweets", "replies"],
+                tweet_fields=["conversation_id", "referenced_tweets", "attachments"],
+                since_id=since_id,
+                pagination_token=pagination_token,
+                max_results=100 if since_id or all_pages else None,
+                expansions=["attachments.media_keys"],
+                media_fields=["url", "alt_text", "variants"],
+            )
+            media_index = {item.media_key: item for item in page.includes.get("media", [])}
+            yield [(tweet, media_index) for tweet in page.data or []]
+            pagination_token = page.meta.get("next_token")
+            # Without since_id, only the latest page is read, so the first run does not toot the whole timeline
+            if not (since_id or all_pages) or not pagination_token:
+                break
+            logger.debug(f"Get next page {pagination_token}")
 
     def get_new_posts(self):
-        logger.debug(f"Get tweets newer than {self.config['status'].get('last_tweet', None)}")
-        new_tweets = self._twitter_client.get_users_tweets(
-            id=self._twitter_user_id,
-            exclude=["retweets", "replies"],
-            tweet_fields=["conversation_id", "referenced_tweets", "attachments"],
-            since_id=self.config["status"].get("last_tweet", None),
-            expansions=["attachments.media_keys"],
-            media_fields=["url", "alt_text", "variants"],
+        since_id = self.config["status"].get("last_tweet", None)
+        logger.debug(f"Get tweets newer than {since_id}")
+        # The timeline is paged newest first, so all new tweets are read before the oldest one is tooted. The buffer is
+        # bounded, as the API only returns the latest 3200 tweets of a user.
+        tweets = []
+        for page in self._get_pages(since_id):
+            # Resolve the short links of each page at once, tootify() will then find them in the cache
+            self._url_resolver.resolve(url for tweet, _ in page for url in SHORT_URL_PATTERN.findall(tweet.text))
+            tweets.extend(page)
+        tweets.sort(key=lambda item: item[0].id)
+        try:
+            for tweet, media_index in tweets:
+                toot = self.tootify(tweet, media_index)
+                # Toots are fetched ahead of posting, so the position only moves on once the toot has been handled
+                toot.checkpoint = self._checkpoint(last_tweet=tweet.id)
+                yield toot
+        finally:
+            self._url_resolver.save()
+
+    def _archive_media(self, archive: Path, tweet_id: str, item) -> Media:
+        # The archive contains the media files, named after the tweet and the original file
+        variants = [
+            {"url": variant["url"], "content_type": variant["content_type"], "bit_rate": int(variant.get("bitrate", 0))}
+            for variant in item.get("video_info", {}).get("variants", [])
+            if variant.get("content_type") == "video/mp4"
+        ]
+        variants.sort(key=lambda variant: variant["bit_rate"], reverse=True)
+        url = variants[0]["url"] if variants else item["media_url_https"]
+        path = archive / "data" / "tweets_media" / f"{tweet_id}-{url.split('?')[0].rsplit('/', 1)[-1]}"
+        if path.exists():
+            return Media(path.resolve().as_uri(), item.get("ext_alt_text"))
+        return Media(url, item.get("ext_alt_text"), variants)
+
+    def _archive_toot(self, archive: Path, tweet) -> Optional[Toot]:
+        if tweet["full_text"].startswith("RT @"):
+            return None
+        replied_to = None
+        if tweet.get("in_reply_to_status_id_str"):
+            if (tweet.get("in_reply_to_screen_name") or "").lower() != self.config["username"].lower():
+                return None
+            replied_to = int(tweet["in_reply_to_status_id_str"])
+        text = self.rewriter.rewrite(html.unescape(tweet["full_text"]))
+        # The archive has the expanded URLs, so no requests are needed
+        for url in tweet.get("entities", {}).get("urls", []):
+            text = text.replace(url["url"], url["expanded_url"])
+        for item in tweet.get("entities", {}).get("media", []):
+            text = text.replace(item["url"], "")
+        return Toot(
+            source=self,
+            reference=int(tweet["id_str"]),
+            status=self._strip_self_referencing_urls(text.strip(), tweet_id=tweet["id_str"]),
+            reply_to=replied_to,
+            media=[
+                self._archive_media(archive, tweet["id_str"], item)
+                for item in tweet.get("extended_entities", {}).get("media", [])
+            ],
         )
-        if new_tweets.data:
-            self.config["status"]["last_tweet"] = max(tweet.id for tweet in new_tweets.data)
-        included_media = new_tweets.includes.get("media", [])
-        return [self.tootify(tweet, included_media) for tweet in sorted(new_tweets.data or [], key=lambda tweet: tweet.id)]
+
+    def _read_archive(self, archive: Path):
+        path = next(path for path in (archive / "data" / "tweets.js", archive / "data" / "tweet.js") if path.exists())
+        # The file is JavaScript: window.YTD.tweets.part0 = [...]
+        content = path.read_text(encoding="utf-8")
+        return [item.get("tweet", item) for item in json.loads(content[content.index("=") + 1 :])]
+
+    def get_history(self, archive: Optional[Path] = None):
+        last_tweet = self.config["status"].get("last_tweet")
+        if last_tweet is None:
+            raise ValueError("Run once with --skip before backfilling, so new tweets are not tooted twice")
+        if archive:
+            tweets = self._read_archive(archive)
+            logger.info(f"Found {len(tweets)} tweets in {archive}")
+            posts = ((int(tweet["id_str"]), tweet) for tweet in tweets if int(tweet["id_str"]) <= int(last_tweet))
+            yield from self._backfill(posts, lambda tweet: self._archive_toot(archive, tweet))
+            return
+        # The API only returns the latest 3200 tweets, older tweets require an archive
+        position = self.config["status"].get("backfill", {}).get("position")
+        tweets = [
+            (tweet.id, (tweet, media_index))
+            for page in self._get_pages(position and position - 1, all_pages=True)
+            for tweet, media_index in page
+            if tweet.id <= int(last_tweet)
+        ]
+        logger.info(f"Found {len(tweets)} tweets to backfill")
+        self._url_resolver.resolve(url for _, (tweet, _) in tweets for url in SHORT_URL_PATTERN.findall(tweet.text))
+        try:
+            yield from self._backfill(tweets, lambda item: self.tootify(*item))
+        finally:
+            self._url_resolver.save()
@@ -0,0 +1,67 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tootify.cache import TTLCache
+from tootify.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UrlResolver:
+    """Resolve short links concurrently by following their redirects.
+
+    Only the headers of each hop are requested, the body of the target is never downloaded. Resolved links are
+    kept in a ``TTLCache``.
+    """
+
+    def __init__(self, cache: TTLCache, max_workers: int = 8, timeout: float = 10) -> None:
+        self._cache = cache
+        self._timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tootify-urls")
+
+    def _resolve(self, url: str) -> Optional[str]:
+        try:
+            response = self._session.head(url, allow_redirects=True, timeout=self._timeout)
+            if response.status_code == 405:
+                # Some targets refuse HEAD. Stream the response and close it before the body is read.
+                with self._session.get(url, allow_redirects=True, timeout=self._timeout, stream=True) as response:
+                    return response.url
+            return response.url
+        except requests.RequestException as e:
+            logger.error(f"Failed to expand {url}: {e}")
+            return None
+
+    def resolve(self, urls: Iterable[str]) -> Dict[str, str]:
+        with metrics.timer("url_expansion"):
+            return self._resolve_all(urls)
+
+    def _resolve_all(self, urls: Iterable[str]) -> Dict[str, str]:
+        result = {}
+        pending = []
+        for url in dict.fromkeys(urls):
+            expanded_url = self._cache.get(url)
+            if expanded_url:
+                result[url] = expanded_url
+            else:
+                pending.append(url)
+        for url, expanded_url in zip(pending, self._executor.map(self._resolve, pending)):
+            if expanded_url:
+                logger.debug(f"Expanded {url} to {expanded_url}")
+                self._cache.set(url, expanded_url)
+                result[url] = expanded_url
+        return result
+
+    def save(self) -> None:
+        self._cache.save()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._session.close()